@@ -0,0 +1,98 @@
+"""
+    The bound variable rules that are in scope, kept as a stack on top of a grammar's own rules.
+
+    A Grammar has one of these (Grammar.bv) that push_bv_rule, pop_bv_rule, and BVRuleContextManager use, but
+    a BVContext can also be made separately and given to BVRuleContextManager, so that bound variables can be
+    managed without touching the grammar's rules.
+"""
+
+from collections import defaultdict
+
+
+class BVContext(object):
+    """A stack of bound variable rules.
+
+    Pushing and popping take constant time, and rules are always removed by identity (never by comparing
+    signatures).
+
+    Attributes
+    ----------
+    stack : list
+        (rule, the total p of its nonterminal's bound variable rules before it was pushed), innermost last
+    rules : dict
+        nonterminal -> the rules in scope for it, in the order they were pushed
+    p : dict
+        nonterminal -> total p of its rules in scope. Only nonterminals with rules in scope are keys.
+    signatures : dict
+        rule signature -> the rules in scope with that signature, in the order they were pushed
+    counts : dict
+        (nonterminal, type, p) -> how many rules like that are in scope
+    keys : list
+        key() for each prefix of the stack
+
+    """
+    def __init__(self):
+        self.stack = []
+        self.rules = defaultdict(list)
+        self.p = dict()
+        self.signatures = dict()
+        self.counts = dict()
+        self.keys = [()]
+
+    def __len__(self):
+        return len(self.stack)
+
+    def __str__(self):
+        return "<BVContext %s>" % str([r for r, _ in self.stack])
+
+    def push(self, r):
+        """ Add a bound variable rule """
+        # Save the old total so that pop restores it exactly (rather than subtracting)
+        self.stack.append((r, self.p.get(r.nt)))
+        self.p[r.nt] = self.p.get(r.nt, 0.0) + r.p
+        self.rules[r.nt].append(r)
+        self.signatures.setdefault(r.get_rule_signature(), []).append(r)
+        x = (r.nt, None if r.to is None else tuple(r.to), r.p)
+        self.counts[x] = self.counts.get(x, 0) + 1
+        self.keys.append(tuple(sorted(self.counts.items())))
+
+    def pop(self, r):
+        """ Remove r, which must be the last rule pushed """
+        top, p = self.stack.pop()
+        assert top is r, "*** Bound variable rules must be removed in the reverse order they were added"
+
+        if p is None:
+            del self.p[r.nt]
+        else:
+            self.p[r.nt] = p
+
+        self.rules[r.nt].pop()
+        if len(self.rules[r.nt]) == 0:
+            del self.rules[r.nt]
+
+        sig = r.get_rule_signature()
+        self.signatures[sig].pop()
+        if len(self.signatures[sig]) == 0:
+            del self.signatures[sig]
+
+        x = (r.nt, None if r.to is None else tuple(r.to), r.p)
+        self.counts[x] -= 1
+        if self.counts[x] == 0:
+            del self.counts[x]
+        self.keys.pop()
+
+    def push_node(self, fn, recurse_up=False):
+        """ Push FunctionNode fn's bound variable rule, and those of all the nodes above it if recurse_up, returning
+        the list of rules pushed """
+        added = []
+        while fn is not None:
+            if fn.added_rule is not None:
+                added.append(fn.added_rule)
+                self.push(fn.added_rule)
+            fn = fn.parent if recurse_up else None
+        return added
+
+    def key(self):
+        """ A hashable summary of the rules in scope, for memoizing: how many there are of each nonterminal,
+        type, and p (but not their names or order) """
+        return self.keys[-1]
@@ -1,17 +1,21 @@
 from LOTlib.Miscellaneous import self_update
 class BVRuleContextManager(object):
 
-    def __init__(self, grammar, fn, recurse_up=False):
+    def __init__(self, grammar, fn, recurse_up=False, context=None):
         """
             This manages rules that we add and subtract in the context of grammar generation. This is a class that is somewhat
             in between Grammar and GrammarRule. It manages creating, adding, and subtracting the bound variable rule via "with" clause in Grammar.
 
             NOTE: The "rule" here is the added rule, not the "bound variable" one (that adds the rule)
             NOTE: If rule is None, then nothing happens
+            NOTE: The rules go on context (a BVContext), which defaults to grammar.bv
 
             This actually could go in FunctionNode, *except* that it needs to know the grammar, which FunctionNodes do not
         """
         self_update(self, locals())
+        if self.context is None:
+            assert not grammar.frozen, "*** Frozen grammars must be given a BVContext"
+            self.context = grammar.bv
         self.added_rules = [] # all of the rules we added -- may be more than one from recurse_up=True
 
     def __str__(self):
@@ -23,12 +27,7 @@ class BVRuleContextManager(object):
 
         assert len(self.added_rules) == 0, "Error, __enter__ called twice on BVRuleContextManager"
 
-        for x in self.fn.up_to(to=None) if self.recurse_up else [self.fn]:
-            if x.added_rule is not None:
-                #print "# Adding rule ", x.added_rule
-                r = x.added_rule
-                self.added_rules.append(r)
-                self.grammar.rules[r.nt].append(r)
+        self.added_rules = self.context.push_node(self.fn, recurse_up=self.recurse_up)
 
     def __exit__(self, t, value, traceback):
 
@@ -36,8 +35,8 @@ class BVRuleContextManager(object):
             return
 
         #print "# Removing rule", r
-        for r in self.added_rules:
-            self.grammar.rules[r.nt].remove(r)
+        for r in reversed(self.added_rules):
+            self.context.pop(r)
 
         # reset
         self.added_rules = []
@@ -0,0 +1,130 @@
+"""
+    An immutable snapshot of a Grammar's rules, indexed by integers and stored in numpy arrays, so that code that
+    works over rules (log probabilities, sampling, counting, packing) does not have to look through lists of
+    GrammarRules and signature tuples every time.
+
+    Get one with Grammar.compile(), which caches it until the grammar changes.
+"""
+
+from math import log
+
+from LOTlib.GrammarRule import BVAddGrammarRule
+
+try: import numpy as np
+except ImportError: import numpypy as np
+
+
+def readonly_array(x, dtype):
+    a = np.array(x, dtype=dtype)
+    a.flags.writeable = False
+    return a
+
+
+class CompiledGrammar(object):
+    """A snapshot of a grammar.
+
+    Arguments
+    ---------
+    grammar : LOTlib.Grammar
+        The grammar to compile. Bound variable rules that are currently in it are left out.
+
+    Attributes
+    ----------
+    version : int
+        grammar.version when we were made; the grammar increments this whenever it changes.
+    nonterminals : tuple
+        The nonterminals with rules, in grammar.rules order.
+    rules : dict
+        nonterminal -> tuple of GrammarRules. A rule's id is its position here, so ids are dense within each
+        nonterminal.
+    signature2id : dict
+        rule signature (which is also a FunctionNode signature) -> rule id within its nonterminal
+    sig2idx : dict
+        rule signature -> a unique index across all nonterminals (see Grammar.sig2idx)
+    idx2rule : tuple
+        the rules in sig2idx order, which goes through nonterminals in order, so each nonterminal's rules are
+        together, in rule id order
+    offsets : dict
+        nonterminal -> the sig2idx index of its first rule (so sig2idx = offsets[nt] + rule id)
+    log_p : dict
+        nonterminal -> numpy array of each rule's log probability, normalized within the nonterminal
+    z : dict
+        nonterminal -> the total p of its rules
+    idx_log_p, idx_log_weight, idx_nt, idx_is_lambda : numpy array
+        For each rule in sig2idx order, its log_p, the log of its (unnormalized) p, the position of its
+        nonterminal in nonterminals, and whether it is a BVAddGrammarRule
+    cumulative : dict
+        nonterminal -> list of cumulative (unnormalized) probabilities, for sampling with bisect
+    is_terminal : dict
+        nonterminal -> numpy array of Grammar.is_terminal_rule for each rule
+    depth_to_terminal : dict
+        nonterminal -> numpy array of Grammar.depth_to_terminal for each rule. The nonterminals' own values
+        are in nonterminal_depth_to_terminal.
+
+    Note
+    ----
+    Nothing here should be modified (the arrays are read-only); to change a grammar, change the grammar and
+    compile again.
+
+    """
+    def __init__(self, grammar):
+        self.version = grammar.version
+
+        # grammar.rules does not have the bound variable rules (those are in grammar.bv)
+        rules = dict()
+        for nt in grammar.rules.keys():
+            if len(grammar.rules[nt]) > 0:
+                rules[nt] = tuple(grammar.rules[nt])
+        self.nonterminals = tuple([nt for nt in grammar.rules.keys() if nt in rules])
+        self.rules = rules
+
+        self.signature2id = dict()
+        self.sig2idx = dict()
+        idx2rule = []
+        duplicates = set()
+        for nt in self.nonterminals:
+            for i, r in enumerate(rules[nt]):
+                sig = r.get_rule_signature()
+                if sig in self.signature2id:
+                    duplicates.add(sig)
+                self.signature2id[sig] = i
+                self.sig2idx[sig] = len(idx2rule)
+                idx2rule.append(r)
+        self.idx2rule = tuple(idx2rule)
+        self.offsets = dict()
+        offset = 0
+        for nt in self.nonterminals:
+            self.offsets[nt] = offset
+            offset += len(rules[nt])
+
+        # Two rules with the same signature can't be told apart, so leave them for Grammar.get_matching_rule to
+        # complain about
+        for sig in duplicates:
+            del self.signature2id[sig]
+
+        self.log_p, self.cumulative, self.is_terminal, self.depth_to_terminal = dict(), dict(), dict(), dict()
+        self.z = dict()
+        self.nonterminal_depth_to_terminal = dict()
+        for nt in self.nonterminals:
+            p = [r.p for r in rules[nt]]
+            self.z[nt] = sum(p)
+            z = log(sum(p))
+            self.log_p[nt] = readonly_array([log(x) - z for x in p], float)
+            self.cumulative[nt] = np.cumsum(p).tolist()
+            self.is_terminal[nt] = readonly_array([grammar.is_terminal_rule(r) for r in rules[nt]], bool)
+            self.depth_to_terminal[nt] = readonly_array([grammar.depth_to_terminal(r) for r in rules[nt]], float)
+            self.nonterminal_depth_to_terminal[nt] = grammar.depth_to_terminal(nt)
+
+        self.idx_log_p = readonly_array(np.concatenate([np.zeros(0)] + [self.log_p[nt] for nt in self.nonterminals]),
+                                        float)
+        self.idx_log_weight = readonly_array([log(r.p) for r in self.idx2rule], float)
+        self.idx_nt = readonly_array([self.nonterminals.index(r.nt) for r in self.idx2rule], int)
+        self.idx_is_lambda = readonly_array([isinstance(r, BVAddGrammarRule) for r in self.idx2rule], bool)
+
+    def nrules(self, nt):
+        """ How many (non bound variable) rules nt has """
+        return len(self.rules.get(nt, ()))
+
+    def rule_id(self, t):
+        """ The id of the rule that made FunctionNode t, or None if it is not one of ours (e.g. a bound variable) """
+        return self.signature2id.get(t.get_rule_signature())
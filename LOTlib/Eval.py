@@ -1,7 +1,12 @@
 """
     Routines for evaling
 """
-import sys
+from time import time
+from weakref import ref
+from types import FunctionType, BuiltinFunctionType
+from collections import OrderedDict, defaultdict
+
+from LOTlib.Miscellaneous import Infinity
 
 """
     The exceptions we throw for all problems in Evaluation
@@ -17,31 +22,58 @@ class RecursionDepthException(EvaluationException):
     pass
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# We define two variables, one for how many function calls have been
-# used in a single function/hypothesis, and one for how many have been
-# run over the entire course of the experiment
-# LOCAL_PRIMITIVE_OPS = 0
-# GLOBAL_PRIMITIVE_OPS = 0
-#  ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# A cache of compiled functions, since samplers see the same programs over and over
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def primitive(fn):
-    """A decocator for basic primitives that increments our counters. Used to be known as @LOTlib_primitive"""
+class FunctionCache(object):
+    """
+        A map from program strings (e.g. str(h) for a LOTHypothesis h, which includes its display) to the functions
+        they compile to, keeping at most maxsize of them and forgetting the least recently used first. maxsize=0
+        turns caching off.
 
+        The functions must not depend on anything but the string, since everyone who compiles that string
+        gets the same function.
     """
-    def inside(*args, **kwargs):
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.functions = OrderedDict() # least recently used first
+        self.hits, self.misses, self.evictions = 0, 0, 0
 
-        global LOCAL_PRIMITIVE_OPS
-        LOCAL_PRIMITIVE_OPS += 1
+    def __len__(self):
+        return len(self.functions)
 
-        global GLOBAL_PRIMITIVE_OPS
-        GLOBAL_PRIMITIVE_OPS += 1
+    def __str__(self):
+        return "<FunctionCache %s>" % ' '.join(['%s=%s' % kv for kv in sorted(self.stats().items())])
 
-        return fn(*args, **kwargs)
+    def get(self, key, make):
+        """ The function for key, calling make() to compile it if we don't have it """
+        if key in self.functions:
+            self.hits += 1
+            f = self.functions.pop(key)
+        else:
+            self.misses += 1
+            f = make()
+            if self.maxsize == 0:
+                return f
+            if len(self.functions) >= self.maxsize:
+                self.functions.popitem(last=False)
+                self.evictions += 1
 
-    return inside
-    """
+        self.functions[key] = f # now the most recently used
+        return f
+
+    def clear(self):
+        """ Forget all of the functions (but not the counts) """
+        self.functions.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.functions)}
+
+function_cache = FunctionCache() # shared by all LOTHypotheses (see LOTHypothesis.compile_function)
 
-    # Just register the primitive
+def primitive(fn):
+    """A decorator for basic primitives, which registers them (see register_primitive). Used to be known as
+    @LOTlib_primitive"""
     register_primitive(fn)
 
     return fn
@@ -65,11 +97,17 @@ def None2None(fn):
 
     return inside
 
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# The namespace that hypotheses are compiled in
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+primitives = dict() # name -> primitive. The globals of compiled hypotheses, so looking up a primitive is one dict hit
+
 def register_primitive(function, name=None):
     """
-        This allows us to load new functions into the evaluation environment.
-        Defaultly all in LOTlib.Primitives are imported. However, we may want to add our
-        own functions, and this makes that possible. As in,
+        This allows us to load new functions into the evaluation environment (LOTlib.Eval.primitives).
+        The modules of LOTlib.Primitives are added by LOTlib.Primitives.load_primitives. However, we may
+        want to add our own functions, and this makes that possible. As in,
 
         register_primitive(flatten)
 
@@ -87,5 +125,166 @@ def register_primitive(function, name=None):
     if name is None: # if we don't specify a name
         name = function.__name__
 
-    sys.modules['__builtin__'].__dict__[name] = function
+    primitives[name] = instrumentation.wrap(name, function) if instrumentation.on else function
+    return function
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Opt-in counting and timing of primitive calls, and evaluation budgets
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class PrimitiveInstrumentation(object):
+    """
+        Counts the calls that compiled hypotheses make to primitives, so that it can time them (while started) and
+        cut off hypotheses that go over their budget (while any budgeted function is alive). To do this, the
+        functions in LOTlib.Eval.primitives are replaced by wrappers (which compiled hypotheses see immediately,
+        since they look their primitives up when called); while neither is on, nothing is wrapped, so it costs
+        nothing.
+
+        Times are cumulative and include any primitives called inside (e.g. by fold_'s function). Calls that
+        primitives make directly to each other in python are not counted.
+
+        Hypotheses compiled while timing also count the primitive calls they make in h.primitive_ops (see
+        LOTHypothesis.compile_function).
+    """
+    def __init__(self):
+        self.timing = False
+        self.counting = False # for budgets, while there are any in budgeted
+        self.budgeted = set() # weak references to the functions returned by budget
+        self.originals = dict() # name -> the primitive we wrapped
+        self.wrappers = dict() # name -> its wrapper
+        self.max_ops, self.deadline = Infinity, Infinity # the budget of the call running now
+        self.next_check = Infinity # when the wrappers next call check (max_ops, or sooner if there is a deadline)
+        self.exceeded = 0 # how many times a budget has been exceeded
+        self.reset()
+
+    @property
+    def on(self):
+        return self.timing or self.counting
+
+    def reset(self):
+        self.calls = defaultdict(int) # name -> number of calls
+        self.time = defaultdict(float) # name -> total seconds
+        self.ops = 0 # total calls
+
+    def start(self):
+        """ Time the primitives in LOTlib.Eval.primitives (and those registered later) """
+        self.timing = True
+        self.rewrap()
+
+    def stop(self):
+        """ Stop timing, keeping the counts """
+        self.timing = False
+        self.rewrap()
+
+    def rewrap(self):
+        """ Put back the primitives, and wrap them again if we are on """
+        for name, w in self.wrappers.items():
+            if primitives.get(name) is w:
+                primitives[name] = self.originals[name]
+        self.originals.clear()
+        self.wrappers.clear()
+
+        if self.on:
+            for name, f in primitives.items():
+                primitives[name] = self.wrap(name, f)
+
+    def wrap(self, name, f):
+        if not isinstance(f, (FunctionType, BuiltinFunctionType)):
+            return f # e.g. constants like PI, and classes
+
+        if self.timing:
+            def inside(*args, **kwargs):
+                self.step()
+                start = time()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.time[name] += time() - start
+                    self.calls[name] += 1
+        else:
+            # as little as we can do, since this is called for every primitive
+            def inside(*args, **kwargs):
+                self.ops += 1
+                if self.ops > self.next_check:
+                    self.check()
+                return f(*args, **kwargs)
+
+        inside.__name__ = f.__name__
+        self.originals[name] = f
+        self.wrappers[name] = inside
+        return inside
+
+    def step(self):
+        self.ops += 1
+        if self.ops > self.next_check:
+            self.check()
+
+    def check(self):
+        """ Raise a TooBigException if the call running now is over its budget, else set when to check next """
+        if self.ops > self.max_ops or time() > self.deadline:
+            self.exceeded += 1
+            raise TooBigException
+        self.set_next_check()
+
+    def set_next_check(self):
+        # with a deadline, the clock is looked at on every call
+        self.next_check = self.ops if self.deadline < Infinity else self.max_ops
+
+    def count(self, h, f):
+        """ Return f, a compiled function of h, counting the primitive calls it makes in h.primitive_ops. Nested
+        calls (e.g. recursion through a RecursiveLOTHypothesis) are counted once. """
+        h.primitive_ops = 0
+        depth = [0]
+
+        def inside(*args, **kwargs):
+            start = self.ops
+            depth[0] += 1
+            try:
+                return f(*args, **kwargs)
+            finally:
+                depth[0] -= 1
+                if depth[0] == 0:
+                    h.primitive_ops += self.ops - start
+        return inside
+
+    def budget(self, f, steps=None, seconds=None):
+        """ Return f, but raising a TooBigException if a call makes more than steps primitive calls or takes more
+        than seconds. Nested calls share the budget of the outermost. Primitive calls are counted until all of the
+        functions this returns have been garbage collected. """
+        def inside(*args, **kwargs):
+            old = self.max_ops, self.deadline
+            if steps is not None:
+                self.max_ops = min(self.max_ops, self.ops + steps)
+            if seconds is not None:
+                self.deadline = min(self.deadline, time() + seconds)
+            self.set_next_check()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.max_ops, self.deadline = old
+                self.set_next_check()
+
+        self.budgeted.add(ref(inside, self.release))
+        if not self.counting:
+            self.counting = True
+            self.rewrap()
+        return inside
+
+    def release(self, r):
+        """ Called when a budgeted function is garbage collected; stop counting when none are left """
+        self.budgeted.discard(r)
+        if self.counting and not self.budgeted:
+            self.counting = False
+            self.rewrap()
+
+    def stats(self):
+        """ name -> (calls, total seconds), for every primitive that has been timed """
+        return dict([(name, (self.calls[name], self.time[name])) for name in self.calls])
+
+    def __str__(self):
+        lines = ["# %s\t%s\t%s" % ('primitive', 'calls', 'seconds')]
+        for name, (calls, seconds) in sorted(self.stats().items(), key=lambda x: -x[1][1]):
+            lines.append("# %s\t%s\t%s" % (name, calls, round(seconds, 6)))
+        return '\n'.join(lines)
 
+instrumentation = PrimitiveInstrumentation() # see LOTlib.SampleStream.PrimitiveStats and LOTHypothesis.step_budget
@@ -0,0 +1,65 @@
+"""
+    A compact, grammar-relative encoding of a tree as two numpy arrays in preorder: the index of the rule that made
+    each node (as in CompiledGrammar.sig2idx) and how many FunctionNodes are below it.
+
+    A bound variable is encoded as nrules + k, where k counts the lambdas between it and the one that bound it
+    (0 for the nearest), so a subtree has the same encoding wherever it is.
+
+    Get one with Grammar.flatten(t), and turn it back into a FunctionNode with Grammar.unflatten.
+"""
+
+try: import numpy as np
+except ImportError: import numpypy as np
+
+
+class FlatTree(object):
+    """A tree as arrays of rule indices and arities.
+
+    Arguments
+    ---------
+    ids : sequence of int
+        The rule index of each node, in preorder
+    arity : sequence of int
+        The number of FunctionNodes directly below each node
+    nrules : int
+        The number of rules in the grammar (so ids >= nrules are bound variables)
+
+    """
+    def __init__(self, ids, arity, nrules):
+        self.nrules = nrules
+        self.ids = np.array(ids, dtype=np.uint16 if nrules + len(ids) < 2**16 else np.uint32)
+        self.arity = np.array(arity, dtype=np.uint8)
+        assert len(self.ids) == len(self.arity)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __eq__(self, other):
+        return isinstance(other, FlatTree) and self.nrules == other.nrules and \
+            np.array_equal(self.ids, other.ids) and np.array_equal(self.arity, other.arity)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.nrules, self.ids.tostring()))
+
+    def __str__(self):
+        return "<FlatTree %s>" % self.ids.tolist()
+
+    def __getstate__(self):
+        # raw bytes are much smaller than pickled arrays
+        return (self.nrules, self.ids.dtype.str, self.ids.tostring(), self.arity.tostring())
+
+    def __setstate__(self, state):
+        self.nrules, dtype, ids, arity = state
+        self.ids = np.fromstring(ids, dtype=dtype)
+        self.arity = np.fromstring(arity, dtype=np.uint8)
+
+    def is_bound(self):
+        """ A boolean array of which nodes are bound variables """
+        return self.ids >= self.nrules
+
+    def rule_counts(self):
+        """ How many times each (non bound variable) rule is used, indexed by rule index """
+        return np.bincount(self.ids[~self.is_bound()], minlength=self.nrules)
@@ -6,7 +6,7 @@ from math import log
 from random import random
 
 from LOTlib.BVRuleContextManager import BVRuleContextManager
-from LOTlib.Miscellaneous import lambdaTrue, lambdaOne, self_update
+from LOTlib.Miscellaneous import lambdaTrue, lambdaOne
 
 
 # ------------------------------------------------------------------------------------------------------------
@@ -18,6 +18,29 @@ def isFunctionNode(x):
     return isinstance(x, FunctionNode)
 
 
+def local_weight(f):
+    """Mark f, a resampleProbability, as depending only on the node it is given and what is below it, so that
+    FunctionNodes may cache the sums of f over their subtrees (see FunctionNode.subtree_weight)."""
+    f.local_weight = True
+    return f
+
+
+returntype_weights = dict() # returntype -> its returntype_weight
+
+
+def returntype_weight(returntype):
+    """A local_weight that is 1 for nodes that return returntype, and 0 for the rest. The same function is
+    returned each time, so each subtree's count of these nodes is cached (see FunctionNode.subtree_weight)."""
+    if returntype not in returntype_weights:
+        returntype_weights[returntype] = local_weight(lambda x: 1.0 if x.returntype == returntype else 0.0)
+    return returntype_weights[returntype]
+
+
+def bv_level_name(level):
+    """The name of the bound variable of a lambda with level lambdas above it, in a de Bruijn grammar (see Grammar)"""
+    return 'bv__%d' % level
+
+
 def cleanFunctionNodeString(x):
     """Makes FunctionNode strings easier to read."""
     s = re.sub("lambda", u"\u03BB", str(x))  # make lambdas the single char
@@ -47,8 +70,24 @@ class FunctionNode(object):
         The name of the function.
     args : doc?
         Arguments of the function
-    bv : doc?
+    added_rule : GrammarRule
         Stores the actual *rule* that was added (so that we can re-add it when we loop through the tree).
+    extra : dict
+        A side table for rarely used attributes (like resample_p), or None if there are none. These are set with
+        set_extra and can be read as ordinary attributes.
+    cached_hash : int
+        Our hash, or None if it has not been computed since we (or anything below us) last changed.
+    cached_pystring, cached_fullstring : str
+        What pystring and fullstring last rendered us as, or None.
+    cached_depth, cached_bv_key
+        The depth and bound variable names (see pystring) that the cached strings were rendered with. The strings
+        are only reused when we are rendered with these again.
+    cached_size, cached_height : int
+        count_nodes() and depth(), or None if they have not been computed since we (or anything below us) last
+        changed.
+    cached_weights : dict
+        resampleProbability -> subtree_weight(resampleProbability), for the local_weight functions we have been
+        sampled with since we (or anything below us) last changed, or None.
 
     Note
     ----
@@ -56,15 +95,92 @@ class FunctionNode(object):
     * Each FunctionNode used to store the rule that generated it. This caused problems when loading a FunctionNode from
       a pickle file and trying to compute its probability under a new grammar. Now, matching to rules is done on the fly
       using get_rule_signature()
+    * FunctionNodes use __slots__, so they have no __dict__. Subclasses must declare __slots__ = () so that setto
+      can change a node's class.
+    * The hash, strings, size, and height are cached. Setting name or args (or setto) clears the caches above the
+      node it changes, but changing the args list in place does not: after n.args[i] = ..., call
+      n.invalidate_caches().
 
     """
-    NoCopy = {'self', 'parent', 'returntype', 'name', 'args', 'parent'}
+    __slots__ = ('parent', 'returntype', '_name', '_args', 'added_rule', 'extra',
+                 'cached_hash', 'cached_pystring', 'cached_fullstring', 'cached_depth', 'cached_bv_key',
+                 'cached_size', 'cached_height', 'cached_weights')
 
     def __init__(self, parent, returntype, name, args):
-        self_update(self,locals())
+        self.parent = parent
+        self.returntype = returntype
+        self._name = name
+        self._args = args
         self.added_rule = None
-        
-        assert self.name is None or isinstance(self.name, str)
+        self.extra = None
+        self.cached_hash = None
+        self.cached_pystring = None
+        self.cached_fullstring = None
+        self.cached_depth = None
+        self.cached_bv_key = None
+        self.cached_size = None
+        self.cached_height = None
+        self.cached_weights = None
+
+        assert self._name is None or isinstance(self._name, str)
+
+    # name and args are properties so that changing them clears the caches that depend on them
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self.invalidate_caches()
+
+    @property
+    def args(self):
+        return self._args
+
+    @args.setter
+    def args(self, args):
+        self._args = args
+        self.invalidate_caches()
+
+    def __getattr__(self, k):
+        # Only called when k is not a slot, so look in the side table
+        if k not in FunctionNode.__slots__ and self.extra is not None and k in self.extra:
+            return self.extra[k]
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, k))
+
+    def set_extra(self, k, v):
+        """Set a rarely used attribute k (one that is not a slot), which can then be read as self.k"""
+        assert k not in FunctionNode.__slots__ and k not in ('name', 'args'), \
+            "*** %s is not an extra attribute" % k
+        if self.extra is None:
+            self.extra = dict()
+        self.extra[k] = v
+
+    def __getstate__(self):
+        # A dict like the __dict__ that FunctionNodes used to have, so old and new pickles are the same
+        state = dict() if self.extra is None else dict(self.extra)
+        for k in ('parent', 'returntype', 'name', 'args', 'added_rule'):
+            state[k] = getattr(self, k)
+        return state
+
+    def __setstate__(self, state):
+        self.parent = None
+        self.added_rule = None
+        self.extra = None
+        self.cached_hash = None
+        self.cached_pystring = None
+        self.cached_fullstring = None
+        self.cached_depth = None
+        self.cached_bv_key = None
+        self.cached_size = None
+        self.cached_height = None
+        self.cached_weights = None
+        for k, v in state.items():
+            if k in ('parent', 'returntype', 'name', 'args', 'added_rule'):
+                setattr(self, k, v)
+            elif k != 'self': # old pickles may have a reference to self
+                self.set_extra(k, v)
 
     def setto(self, q):
         """Makes all the parts the same as q, not copies.
@@ -73,7 +189,8 @@ class FunctionNode(object):
 
         """
         old_parent = self.parent        # preserve my parent
-        self.__dict__ = q.__dict__
+        for k in FunctionNode.__slots__:
+            setattr(self, k, getattr(q, k))
         self.__class__ = q.__class__    # to update in case q is a different subtype of FunctionNode.
                                         # NOTE: Setting __class__ is not a recommended thing to do.
         # and we must fix the kid refs. Everything else should be right.
@@ -81,13 +198,29 @@ class FunctionNode(object):
             a.parent = self
         self.parent = old_parent
 
+        # our caches are q's, but everything above us has changed
+        if old_parent is not None:
+            old_parent.invalidate_caches()
+
+    def invalidate_caches(self):
+        """Forget the cached hash, strings, size, and height of this node and everything above it. Setting name or
+        args calls this; call it yourself after changing the args list in place."""
+        n = self
+        # nodes above one without any caches don't have any either
+        while n is not None and not (n.cached_hash is None and n.cached_pystring is None and
+                                     n.cached_fullstring is None and n.cached_size is None and
+                                     n.cached_weights is None):
+            n.cached_hash = n.cached_pystring = n.cached_fullstring = None
+            n.cached_size = n.cached_height = n.cached_weights = None
+            n = n.parent
+
     def get_rule_signature(self):
         """ The rule signature is used to pair up FunctionNodes with GrammarRules in computing log probability
             So it needs to be synced to GrammarRule.get_rule_signature and provide a unique identifier
         """
-        sig = [self.returntype, self.name]
-        if self.args is not None:
-            sig.extend([a.returntype if isFunctionNode(a) else a for a in self.args])
+        sig = [self.returntype, self._name]
+        if self._args is not None:
+            sig.extend([a.returntype if isFunctionNode(a) else a for a in self._args])
         return tuple(sig)
 
     def __copy__(self, shallow=False):
@@ -96,33 +229,35 @@ class FunctionNode(object):
         Arguments
         ---------
         shallow : bool
-            if True, this does not copy the children (self.to points to the same as what we return)
+            if True, this does not copy the children (self.to points to the same as what we return), and their
+            parent refs still point to us
 
         Note
         ----
         The rule is NOT deeply copied (regardless of shallow)
 
         """
-        fn = FunctionNode(self.parent, self.returntype, self.name, None)
+        fn = FunctionNode(self.parent, self.returntype, self._name, None)
+        fn.added_rule = copy(self.added_rule)
 
         # And then then copy the rest -- needed for if we add info to FunctionNodes, like a resample_p
-        for k in set(self.__dict__.keys()).difference(FunctionNode.NoCopy): # None of these!
-            fn.__dict__[k] = copy(self.__dict__[k])
+        if self.extra is not None:
+            fn.extra = dict([(k, copy(v)) for k, v in self.extra.iteritems()])
 
-        if (not shallow) and self.args is not None:
-            fn.args = map(copy, self.args)
-        else:
-            fn.args = self.args
+        if (not shallow) and self._args is not None:
+            fn.args = map(copy, self._args)
 
-        # and update 
-        for a in fn.argFunctionNodes():
-            a.parent = fn 
+            # and update
+            for a in fn.argFunctionNodes():
+                a.parent = fn
+        else:
+            fn.args = self._args # still our children, so leave their parent refs alone
 
         return fn 
         
     def is_nonfunction(self):
         """Returns True if the Node contains no function arguments, False otherwise."""
-        return self.args is None
+        return self._args is None
 
     def is_function(self):
         """Returns True if the Node contains function arguments, False otherwise."""
@@ -136,7 +271,7 @@ class FunctionNode(object):
         A leaf may be a function, but its args are specified in the grammar.
 
         """
-        return (self.args is None) or all([not isFunctionNode(c) for c in self.args])
+        return (self._args is None) or all([not isFunctionNode(c) for c in self._args])
 
     def is_root(self):
         return self.parent is None
@@ -166,14 +301,14 @@ class FunctionNode(object):
 
         """
         # the tree should be represented as the empty set if the function node has no name
-        if self.name == '':
+        if self._name == '':
             x = []
         else:
-            x = [self.name]
+            x = [self._name]
             
         # and we're now ready to loop over the function node's arguments
-        if self.args is not None:
-            x.extend([a.as_list(d=d+1, bv_names=bv_names) if isFunctionNode(a) else a for a in self.args])
+        if self._args is not None:
+            x.extend([a.as_list(d=d+1, bv_names=bv_names) if isFunctionNode(a) else a for a in self._args])
         
         return x
 
@@ -185,21 +320,21 @@ class FunctionNode(object):
         Doesn't handle any details and is meant to just be quick.
 
         """
-        if self.args is None:
-            return str(self.name)  # simple call
+        if self._args is None:
+            return str(self._name)  # simple call
 
         else:
             # Don't use + to concatenate strings.
-            return '{} {}'.format(str(self.name), ','.join(map(str, self.args)))
+            return '{} {}'.format(str(self._name), ','.join(map(str, self._args)))
 
     def fullprint(self, d=0):
         """A handy printer for debugging"""
         tabstr = "  .  " * d
-        print tabstr, self.returntype, self.name, "\t", self.added_rule
+        print tabstr, self.returntype, self._name, "\t", self.added_rule
 
 
-        if self.args is not None:
-            for a in self.args:
+        if self._args is not None:
+            for a in self._args:
                 if isFunctionNode(a):
                     a.fullprint(d+1)
                 else:
@@ -212,10 +347,10 @@ class FunctionNode(object):
         Mainly useful for combinatory logic, or "pure" trees
 
         """
-        if self.args is None:
-            return self.name
-        elif self.name == cons:
-            return map(lambda x: x.liststring(), self.args)
+        if self._args is None:
+            return self._name
+        elif self._name == cons:
+            return map(lambda x: x.liststring(), self._args)
         else:
             assert False, "FunctionNode must only use cons to call liststring!"
 
@@ -243,31 +378,43 @@ class FunctionNode(object):
         NOTE: We need to do thsi using fullstring instead of pystring in order to avoid the fact that pystring ignores
         returntypes and nodes whose name is ''
 
+        But we don't build the strings: we compare the (cached) hashes and then walk both trees with
+        same_structure, which is True exactly when the fullstrings are equal.
+
         """
-        return fullstring(self) == fullstring(other)
+        if self is other:
+            return True
+        if not isFunctionNode(other) or hash(self) != hash(other):
+            return False
+        return same_structure(self, other)
 
-    # TODO: overwrite these with something faster
-    # hash trees. This just converts to string -- maybe too slow?
     def __hash__(self):
-        # # An attempt to speed things up -- not so great!
-        # hsh = self.ruleid
-        # if self.args is not None:
-        #     for a in filter(isFunctionNode, self.args):
-        #         hsh = hsh ^ hash(a)
-        # return hsh
-        #
-        # # use a quicker string hash
-        # return hash(self.quickstring())
+        """A Merkle hash of the tree below us, cached in each node.
 
-        # normal string hash -- faster?
-        return hash(str(self))
+        Bound variable uses hash the same whatever their (uuid) names, so trees that differ only in what their
+        bound variables are called hash the same. Which lambda a variable refers to is left to __eq__.
+
+        """
+        if self.cached_hash is None:
+            if isinstance(self, BVUseFunctionNode):
+                h = (BVUseFunctionNode, self.returntype)
+            elif isinstance(self, BVAddFunctionNode):
+                h = (BVAddFunctionNode, self.returntype, self._name, self.added_rule.bv_prefix)
+            else:
+                h = (self.returntype, self._name)
+
+            if self._args is not None:
+                h = h + tuple([hash(a) for a in self._args])
+
+            self.cached_hash = hash(h)
+        return self.cached_hash
 
 
     def __cmp__(self, x):
         return cmp(str(self), str(x))
 
     def __len__(self):
-        return len([a for a in self])
+        return self.count_nodes()
 
     def log_probability(self):
         """Compute the log probability of a tree."""
@@ -277,34 +424,33 @@ class FunctionNode(object):
         """Return all subnodes -- no iterator
 
         """
-        return [g for g in self]
+        return list(self)
 
     def nargs(self):
         """
         :return: the number of arguments, or -1 if our self.args is None
         """
-        if self.args is None:
+        if self._args is None:
             return -1
         else:
-            return len(self.args)
+            return len(self._args)
 
     def argFunctionNodes(self):
-        """Yield FunctionNode immediately below.
+        """Return a list of the FunctionNodes immediately below.
 
         Also handles args is None, so we don't have to check constantly
 
         """
-        if self.args is not None:
-            # TODO: In python 3, use yeild from
-            for n in filter(isFunctionNode, self.args):
-                yield n
+        if self._args is None:
+            return []
+        return [a for a in self._args if isinstance(a, FunctionNode)]
 
     def argStrings(self):
         """
         Yields strings below (e.g. non-FunctionNodes), handling None
         """
-        if self.args is not None:
-            for n in self.args:
+        if self._args is not None:
+            for n in self._args:
                 if isinstance(n, str):
                     yield n
 
@@ -312,18 +458,20 @@ class FunctionNode(object):
     def argTypes(self):
         # A list of the strings or returntypes of by args
         # This should be equal to what my rule produced
-        if self.args is None:
+        if self._args is None:
             return None
         else:
-           return [a.returntype if isinstance(a, FunctionNode) else a for a in self.args]
+           return [a.returntype if isinstance(a, FunctionNode) else a for a in self._args]
 
 
     def is_terminal(self):
         """A FunctionNode is considered a "terminal" if it has no FunctionNodes below."""
-        return self.args is None or len(filter(isFunctionNode, self.args)) == 0
+        return self._args is None or not any([isinstance(a, FunctionNode) for a in self._args])
 
     def __iter__(self):
-        """Iterater for subnodes.
+        """Iterater for subnodes, in preorder.
+
+        This uses an explicit stack (see walk), so each node takes the same time however deep it is.
 
         Note
         ----
@@ -331,30 +479,53 @@ class FunctionNode(object):
         * If the tree must be modified, use self.subnodes().
 
         """
-        yield self
+        stack = [self]
+        while stack:
+            n = stack.pop()
+            yield n
 
-        for a in self.argFunctionNodes():
-            for ssn in a:
-                yield ssn
+            if n.args is not None:
+                stack.extend([a for a in reversed(n.args) if isinstance(a, FunctionNode)])
+
+    def walk(self, postorder=False, yield_depth=False):
+        """Iterate over us and all the FunctionNodes below us, with an explicit stack instead of recursion.
+
+        Arguments
+        ---------
+        postorder : bool
+            If True, each node comes after everything below it; else before (as in __iter__).
+        yield_depth : bool
+            If True, we yield (node, depth) instead of node, where our depth is 0.
+
+        """
+        stack = [(self, 0, False)] # (node, depth, whether its children are already on the stack)
+        while stack:
+            n, d, expanded = stack.pop()
+
+            if postorder and not expanded:
+                stack.append((n, d, True))
+            else:
+                yield (n, d) if yield_depth else n
+                if postorder:
+                    continue
+
+            if n.args is not None:
+                stack.extend([(a, d+1, False) for a in reversed(n.args) if isinstance(a, FunctionNode)])
 
     def iterdepth(self):
         """Iterates subnodes, yielding node and depth."""
-        yield (self, 0)
-
-        if self.args is not None:
-            for a in self.argFunctionNodes():
-                for ssn, dd in a.iterdepth():
-                    yield (ssn, dd+1)
+        return self.walk(yield_depth=True)
 
     def all_leaves(self):
         """Returns a generator for all leaves of the subtree rooted at the instantiated FunctionNode."""
-        if self.args is not None:
-            for i in range(len(self.args)):  # loop through kids
-                if isFunctionNode(self.args[i]):
-                    for ssn in self.args[i].all_leaves():
-                        yield ssn
-                else:
-                    yield self.args[i]
+        stack = [self]
+        while stack:
+            x = stack.pop()
+            if isinstance(x, FunctionNode):
+                if x.args is not None:
+                    stack.extend(reversed(x.args))  # loop through kids
+            else:
+                yield x
 
     def string_below(self, sep=" "):
         """The string of terminals (leaves) below the current FunctionNode in the parse tree.
@@ -390,13 +561,59 @@ class FunctionNode(object):
 
     def count_subnodes(self, predicate=lambdaTrue):
         """Returns the subnode count."""
-        return len(filter(predicate, self))
+        if predicate is lambdaTrue:
+            if self.cached_size is None:
+                self.cache_sizes()
+            return self.cached_size
+        return sum([1 for n in self if predicate(n)])
 
     def depth(self):
         """Returns the depth of the tree (how many embeddings below)."""
-        depths = [a.depth() for a in self.argFunctionNodes()]
-        depths.append(-1)  # for no function nodes (+1=0)
-        return max(depths)+1
+        if self.cached_height is None:
+            self.cache_sizes()
+        return self.cached_height
+
+    def cache_sizes(self):
+        """Fill in cached_size and cached_height here and below, skipping the subtrees that already have them (so
+        after a change, this only visits the changed nodes and their children)."""
+        stack = [(self, False)]
+        while stack:
+            n, expanded = stack.pop()
+            if n.cached_size is not None:
+                continue
+
+            kids = n.argFunctionNodes()
+            if expanded:
+                n.cached_size = 1 + sum([a.cached_size for a in kids])
+                n.cached_height = 1 + max([a.cached_height for a in kids]) if kids else 0
+            else:
+                stack.append((n, True))
+                stack.extend([(a, False) for a in kids if a.cached_size is None])
+
+    def subtree_weight(self, resampleProbability):
+        """The sum of resampleProbability over us and everything below us, which must be a local_weight (or
+        lambdaOne). This is cached in each node, so after a change only the changed nodes and their children are
+        looked at again."""
+        if resampleProbability is lambdaOne:
+            return 1.0 * self.count_nodes()
+
+        if self.cached_weights is None or resampleProbability not in self.cached_weights:
+            stack = [(self, False)]
+            while stack:
+                n, expanded = stack.pop()
+                if n.cached_weights is not None and resampleProbability in n.cached_weights:
+                    continue
+
+                if expanded:
+                    if n.cached_weights is None:
+                        n.cached_weights = dict()
+                    n.cached_weights[resampleProbability] = 1.0*resampleProbability(n) + \
+                        sum([a.cached_weights[resampleProbability] for a in n.argFunctionNodes()])
+                else:
+                    stack.append((n, True))
+                    stack.extend([(a, False) for a in n.argFunctionNodes()])
+
+        return self.cached_weights[resampleProbability]
 
     def sample_node_normalizer(self, resampleProbability=lambdaOne):
         """
@@ -404,6 +621,8 @@ class FunctionNode(object):
         * resampleProbability -- a function that gives the resample probability (NOT log prob.) of each node.
         NOTE: We allow resampleProbability to return a boolean, for 0/1 probability.
         """
+        if resampleProbability is lambdaOne or getattr(resampleProbability, 'local_weight', False):
+            return self.subtree_weight(resampleProbability)
         return sum([ 1.0*resampleProbability(x) for x in self])
 
     def sample_subnode(self, resampleProbability=lambdaOne):
@@ -412,18 +631,16 @@ class FunctionNode(object):
         We return a sampled tree and the log probability of sampling it
 
         """
+        if resampleProbability is lambdaOne or getattr(resampleProbability, 'local_weight', False):
+            path, lp = self.sample_subnode_path(resampleProbability)
+            return [path[-1], lp]
+
         Z = self.sample_node_normalizer(resampleProbability=resampleProbability) # the total probability
         if not (Z > 0.0):
             raise NodeSamplingException
 
         r = random() * Z # now select a random number (giving a random node)
 
-        # for t in self:
-        #     trp = float(resampleProbability(t))
-        #     r -= trp
-        #     print "\t", r, trp, t
-        #
-
         for t in self:
             trp = float(resampleProbability(t))
             r -= trp
@@ -432,6 +649,109 @@ class FunctionNode(object):
 
         assert False, "Should not get here"
 
+    def sample_subnode_path(self, resampleProbability=lambdaOne):
+        """Sample a subnode like sample_subnode, but return the list of nodes from us down to it.
+
+        The path is found by walking down from us, so it is right even in trees made by replace_at_path, where
+        parent refs may point into other trees.
+
+        If resampleProbability is lambdaOne or a local_weight, we go straight down using subtree_weight to skip
+        whole subtrees, so (once the weights are cached) this takes time proportional to the depth, not the size,
+        of the tree. Either way, the node we choose for a given random() is the same as in a preorder scan.
+
+        """
+        Z = self.sample_node_normalizer(resampleProbability=resampleProbability) # the total probability
+        if not (Z > 0.0):
+            raise NodeSamplingException
+
+        r = random() * Z
+
+        if resampleProbability is lambdaOne or getattr(resampleProbability, 'local_weight', False):
+            path = [self]
+            while True:
+                n = path[-1]
+                trp = float(resampleProbability(n))
+                r -= trp
+
+                kids = [(a, a.subtree_weight(resampleProbability)) for a in n.argFunctionNodes()]
+                kids = [(a, w) for a, w in kids if w > 0.0]
+                if trp > 0.0 and (r <= 0 or len(kids) == 0): # (no kids left can only be from roundoff)
+                    return [path, log(trp) - log(Z)]
+
+                for i, (a, w) in enumerate(kids):
+                    if r <= w or i == len(kids)-1:
+                        break
+                    r -= w
+                path.append(a)
+
+        path = []
+        for t, d in self.iterdepth():
+            del path[d:]
+            path.append(t)
+
+            trp = float(resampleProbability(t))
+            r -= trp
+            if r <= 0:
+                return [path, log(trp) - log(Z)]
+
+        assert False, "Should not get here"
+
+    def count_returntype(self, returntype):
+        """How many nodes here and below return returntype (cached, like count_nodes)"""
+        return int(self.subtree_weight(returntype_weight(returntype)))
+
+    def returntype_paths(self, returntype):
+        """Yield the path (as in sample_subnode_path) to each node here and below that returns returntype, in
+        preorder. This only goes into subtrees that have such nodes, using the cached counts."""
+        f = returntype_weight(returntype)
+
+        path = []
+        stack = [(self, 0)] if self.subtree_weight(f) > 0 else []
+        while stack:
+            n, d = stack.pop()
+            del path[d:]
+            path.append(n)
+
+            if n.returntype == returntype:
+                yield list(path)
+            stack.extend([(a, d+1) for a in reversed(n.argFunctionNodes()) if a.subtree_weight(f) > 0])
+
+    def replace_at_path(self, path, new):
+        """Return a new tree that is us with path[-1] replaced by new, where path is a list of nodes from us
+        down (as from sample_subnode_path).
+
+        Only the nodes on the path are copied; everything else is shared with us. So this takes time and memory
+        proportional to the depth, not the size, of the tree, but neither tree may be changed in place afterwards.
+
+        Note
+        ----
+        The shared subtrees keep their parent refs, which point into us (or whatever tree they were first in).
+        Those parents are at the same place and have the same bound variables as in the new tree, so recurse_up
+        contexts are still right; but to find the nodes of the new tree, walk down from its root. This also means
+        that:
+          * check_parent_refs fails on the new tree, and invalidate_caches on a shared node walks up the old one
+            (which is one more reason not to change either tree in place).
+          * The new tree keeps the old ones reachable through those parent refs, for as long as it shares nodes
+            with them. A tree that is kept for a while (e.g. an accepted proposal in a long chain) should be
+            compacted with copy(), which gives it its own nodes with the right parents.
+
+        """
+        assert path[0] is self
+
+        for i in xrange(len(path)-1, 0, -1):
+            parent = path[i-1].__copy__(shallow=True)
+            parent.args = list(parent.args)
+
+            # find where the old node was (by identity, since equal siblings are common)
+            j = [k for k, a in enumerate(parent.args) if a is path[i]][0]
+            parent.args[j] = new
+            new.parent = parent
+
+            new = parent
+
+        new.parent = self.parent
+        return new
+
     # get a description of the input and output types
     # if collapse_terminal then we just map non-FunctionNodes to "TERMINAL"
     def type(self):
@@ -447,9 +767,9 @@ class FunctionNode(object):
         what's below
 
         """
-        if self.name == '':
+        if self._name == '':
             assert self.nargs() == 1, "**** Nameless calls must have exactly 1 arg"
-            return self.args[0].type()
+            return self._args[0].type()
         if not (isinstance(self, BVAddFunctionNode) and self.added_rule is not None):
             return self.returntype
         else:
@@ -460,7 +780,7 @@ class FunctionNode(object):
             else:
                 t = self.added_rule.nt
 
-            return (self.args[0].type(), t)
+            return (self._args[0].type(), t)
 
     def is_canonical_order(self, symmetric_ops):
         """Take a set of symmetric (commutative) ops (plus, minus, times, etc, not divide) and asserts that
@@ -481,11 +801,11 @@ class FunctionNode(object):
         if self.nargs() < 1: # None or zero args
             return True
 
-        if self.name in symmetric_ops:
+        if self._name in symmetric_ops:
             # Then we must check children
-            if self.args is not None:
+            if self._args is not None:
                 for i in xrange(self.nargs()-1):
-                    if self.args[i].name > self.args[i+1].name:
+                    if self._args[i].name > self._args[i+1].name:
                         return False
 
         # Now check the children, whether or not we are symmetrical
@@ -511,13 +831,13 @@ class FunctionNode(object):
         """
         if isFunctionNode(y):
             if (y.returntype != self.returntype) or \
-               (y.name != self.name) or \
+               (y.name != self._name) or \
                (y.nargs() != self.nargs()):
                 return False
             if y.args is None:
-                return self.args is None
+                return self._args is None
 
-            for a, b in zip(self.args, y.args):
+            for a, b in zip(self._args, y.args):
                 if isFunctionNode(a):
                     if not a.partial_subtree_root_match(b):
                         return False
@@ -564,11 +884,11 @@ class FunctionNode(object):
         Partial here means that we include nonterminals with probability p
 
         """
-        if self.args is None:
+        if self._args is None:
             return copy(self)
 
         newargs = []
-        for a in self.args:
+        for a in self._args:
             if isFunctionNode(a):
                 if random() < p:
                     newargs.append(a.returntype)
@@ -609,13 +929,47 @@ class FunctionNode(object):
             if self.added_rule is not None:
                 remap[self.added_rule.name] = newbv
                 self.added_rule.name = newbv
-        elif isinstance(self, BVUseFunctionNode):
-            self.name = remap.get(self.name, self.name)
+        elif isinstance(self, BVUseFunctionNode) and self._name in remap:
+            self.name = remap[self._name]
+            self.invalidate_caches() # free variables are rendered with their names
 
         for a in self.argFunctionNodes():
             a.uniquify_bv(remap)
 
-    def iterate_subnodes(self, grammar, t=None, d=0, predicate=lambdaTrue, yield_depth=False, recurse_up=False):
+    def renumber_bv(self):
+        """
+        In a de Bruijn grammar, rename the bound variables of the lambdas here and below by their levels, counting
+        the lambdas above us. This is needed after a lambda is inserted or deleted above us.
+
+        """
+        level = 0 if self.parent is None else len([a for a in self.parent.up_to() if isinstance(a, BVAddFunctionNode)])
+        self.invalidate_caches()
+
+        remap = dict() # old name -> new name, for the lambdas we are below
+        stack = [(self, level)] # nodes (with their level), or (old name, what it mapped to before) to restore
+        while stack:
+            n, l = stack.pop()
+            if not isinstance(n, FunctionNode):
+                if l is None:
+                    del remap[n]
+                else:
+                    remap[n] = l
+                continue
+
+            if isinstance(n, BVAddFunctionNode):
+                old, new = n.added_rule.name, bv_level_name(l)
+                stack.append((old, remap.get(old)))
+                remap[old] = new
+                n.added_rule.name = new
+                l += 1
+            elif isinstance(n, BVUseFunctionNode) and n.name in remap:
+                n.name = remap[n.name]
+
+            n.cached_pystring = n.cached_fullstring = None
+            stack.extend([(a, l) for a in reversed(n.argFunctionNodes())])
+
+    def iterate_subnodes(self, grammar, t=None, d=0, predicate=lambdaTrue, yield_depth=False, recurse_up=False,
+                         context=None):
         """Iterate through all subnodes of node *t*, while updating the added rules (bound variables)
         so that at each subnode, the grammar is accurate to what it was.
 
@@ -631,6 +985,8 @@ class FunctionNode(object):
             Filter only the nodes that match this function (i.e. eval (function(fn) == True) on each fn).
         recurse_up : bool
             Do we recurse all the way up and add all above nodes too?
+        context : LOTlib.BVContext
+            Where to add the bound variables (default grammar.bv)
         """
         if not t:
             t = self
@@ -639,12 +995,34 @@ class FunctionNode(object):
 
         # Define a new context that is the grammar with the rule added.
         # Then, when we exit, it's still right.
-        with BVRuleContextManager(grammar, t, recurse_up=recurse_up):
-            for a in t.argFunctionNodes():
-                # Pass up anything from below
-                for g in self.iterate_subnodes(grammar, a, d=d+1, yield_depth=yield_depth,
-                                               predicate=predicate, recurse_up=False): # we never have to recurse up
-                    yield g
+        manager = BVRuleContextManager(grammar, t, recurse_up=recurse_up, context=context)
+        with manager:
+            context = manager.context
+
+            # An explicit stack rather than nested generators, so each node costs the same however deep it is.
+            # A None node marks where to pop the rule pushed by the node below it on the stack.
+            pushed = []
+            stack = [(a, d+1) for a in reversed(t.argFunctionNodes())]
+            try:
+                while stack:
+                    n, nd = stack.pop()
+                    if n is None:
+                        context.pop(pushed.pop())
+                        continue
+
+                    if predicate(n):
+                        yield (n, nd) if yield_depth else n
+
+                    children = n.argFunctionNodes()
+                    if n.added_rule is not None and children:
+                        context.push(n.added_rule)
+                        pushed.append(n.added_rule)
+                        stack.append((None, nd))
+                    stack.extend([(a, nd+1) for a in reversed(children)])
+            finally:
+                # if we are closed early, leave the context as we found it
+                while pushed:
+                    context.pop(pushed.pop())
 
 
 
@@ -660,6 +1038,8 @@ class BVAddFunctionNode(FunctionNode):
 
     This should almost never need to be called, as it is defaultly handled by LOTlib.Grammar
     """
+    __slots__ = ()
+
     def __init__(self, parent, returntype, name, args,  added_rule=None):
         FunctionNode.__init__(self, parent, returntype, name, args)
         self.added_rule = added_rule
@@ -685,16 +1065,17 @@ class BVAddFunctionNode(FunctionNode):
         shallow: if True, this does not copy the children (self.to points to the same as what we return)
 
         """
-        fn = BVAddFunctionNode(self.parent, self.returntype, self.name, None,
+        fn = BVAddFunctionNode(self.parent, self.returntype, self._name, None,
             added_rule=copy(self.added_rule)) ## TODO: We should not need to copy added_rule
 
-        if (not shallow) and self.args is not None:
-            fn.args = map(copy, self.args)
-        else:
-            fn.args = self.args
+        if (not shallow) and self._args is not None:
+            fn.args = map(copy, self._args)
 
-        for a in fn.argFunctionNodes():
-            a.parent = fn
+            # and update
+            for a in fn.argFunctionNodes():
+                a.parent = fn
+        else:
+            fn.args = self._args # still our children, so leave their parent refs alone
 
         return fn
 
@@ -714,7 +1095,7 @@ class BVAddFunctionNode(FunctionNode):
             bv_names = dict()    
         
         # Since this is a lambda, we should add an item to the bv_names dictionary
-        # print "We are a lambda node...", self.name
+        # print "We are a lambda node...", self._name
         bvn = ''
         if self.added_rule is not None:
             bvn = self.added_rule.bv_prefix+str(d)
@@ -736,9 +1117,16 @@ class BVUseFunctionNode(FunctionNode):
     """
     A FunctionNode that uses a bound variable. As in, the use of "x" in lambda x: x+1
     """
+    __slots__ = ()
+
     def __init__(self, parent, returntype, name, args, bv_prefix=None):
         FunctionNode.__init__(self, parent, returntype, name, args)
-        self.bv_prefix = bv_prefix
+        if bv_prefix is not None: # usually it is, so don't make a side table for it
+            self.set_extra('bv_prefix', bv_prefix)
+
+    @property
+    def bv_prefix(self):
+        return None if self.extra is None else self.extra.get('bv_prefix')
 
     def as_list(self, d=0, bv_names=None):
         """Returns a list representation of the FunctionNode with function/self.name as the first element.
@@ -750,13 +1138,13 @@ class BVUseFunctionNode(FunctionNode):
 
         """
         # the tree should be represented as the empty set if the function node has no name
-        assert self.name is not None
-        assert self.name in bv_names
-        x = [bv_names[self.name]]
+        assert self._name is not None
+        assert self._name in bv_names
+        x = [bv_names[self._name]]
 
         # and we're now ready to loop over the function node's arguments
-        if self.args is not None:
-            x.extend([a.as_list(d=d+1, bv_names=bv_names) if isFunctionNode(a) else a for a in self.args])
+        if self._args is not None:
+            x.extend([a.as_list(d=d+1, bv_names=bv_names) if isFunctionNode(a) else a for a in self._args])
  
         return x
 
@@ -770,15 +1158,16 @@ class BVUseFunctionNode(FunctionNode):
             shallow: if True, this does not copy the children (self.to points to the same as what we return)
 
         """
-        fn = BVUseFunctionNode(self.parent, self.returntype, self.name, None, bv_prefix=self.bv_prefix)
+        fn = BVUseFunctionNode(self.parent, self.returntype, self._name, None, bv_prefix=self.bv_prefix)
         
-        if (not shallow) and self.args is not None:
-            fn.args = map(copy, self.args)
-        else:
-            fn.args = self.args
+        if (not shallow) and self._args is not None:
+            fn.args = map(copy, self._args)
 
-        for a in fn.argFunctionNodes():
-            a.parent = fn
+            # and update
+            for a in fn.argFunctionNodes():
+                a.parent = fn
+        else:
+            fn.args = self._args # still our children, so leave their parent refs alone
 
         return fn
 
@@ -829,13 +1218,14 @@ def schemestring(x, d=0, bv_names=None):
                 return "(%s %s)" % (name, map(lambda a: schemestring(a,d+1, bv_names=bv_names), x.args))
 
 
-def fullstring(x, d=0, bv_names=None):
+def fullstring(x, d=0, bv_names=None, bv_key=None):
     """
     A string mapping function that is for equality checking. This is necessary because pystring silently ignores
     FunctionNode.names that are ''. Here, we print out everything, including returntypes
     :param x:
     :param d:
     :param bv_names:
+    :param bv_key: bv_names as a tuple, which each node memoizes its string under (see pystring)
     :return:
     """
 
@@ -844,41 +1234,108 @@ def fullstring(x, d=0, bv_names=None):
     elif isFunctionNode(x):
 
         if bv_names is None:
-            bv_names = dict()
+            bv_names, bv_key = dict(), ()
 
+        if bv_key is not None and x.cached_fullstring is not None and x.cached_depth == d and x.cached_bv_key == bv_key:
+            return x.cached_fullstring
 
         if isinstance(x, BVAddFunctionNode):
             # On a lambda, we must add the introduced bv, and then remove it again afterwards
 
             bvn = x.added_rule.bv_prefix+str(d)
             bv_names[x.added_rule.name] = bvn
+            below_key = None if bv_key is None else bv_key + ((x.added_rule.name, bvn),)
 
-            ret = '%s<%s> %s: %s' % ( x.name, x.returntype, bvn, [fullstring(xi, d=d+1, bv_names=bv_names) for xi in x.args] )
+            ret = '%s<%s> %s: %s' % ( x._name, x.returntype, bvn, [fullstring(xi, d=d+1, bv_names=bv_names, bv_key=below_key) for xi in x._args] )
 
             del bv_names[x.added_rule.name]
-
-            return ret
         else:
 
-            name = x.name
+            name = x._name
             if isinstance(x, BVUseFunctionNode):
-                name = bv_names.get(x.name, x.name)
+                name = bv_names.get(x._name, x._name)
 
-            if x.args is None:
-                return "%s<%s>"%(name, x.returntype)
+            if x._args is None:
+                ret = "%s<%s>"%(name, x.returntype)
             else:
-                return "%s<%s>(%s)" % (name,
-                                       x.returntype,
-                                       ', '.join(map(lambda a: fullstring(a, d=d+1, bv_names=bv_names), x.args)))
+                ret = "%s<%s>(%s)" % (name,
+                                      x.returntype,
+                                      ', '.join([fullstring(a, d=d+1, bv_names=bv_names, bv_key=bv_key) for a in x._args]))
 
+        if bv_key is not None:
+            if x.cached_depth != d or x.cached_bv_key != bv_key: # we were rendered somewhere else before
+                x.cached_depth, x.cached_bv_key, x.cached_pystring = d, bv_key, None
+            x.cached_fullstring = ret
 
+        return ret
 
 
-def pystring(x, d=0, bv_names=None):
+def same_structure(x, y):
+    """
+    Is fullstring(x) == fullstring(y)? This walks x and y together instead of making the strings, and gives bound
+    variables the same names that fullstring would.
+    """
+    x_bv_names, y_bv_names = dict(), dict()
+
+    stack = [(x, y, 0)] # pairs to compare (with their depth), or pairs of bound variables to forget
+    while stack:
+        item = stack.pop()
+        if len(item) == 2:
+            del x_bv_names[item[0]]
+            del y_bv_names[item[1]]
+            continue
+
+        x, y, d = item
+        if not (isinstance(x, FunctionNode) and isinstance(y, FunctionNode)):
+            if x != y:
+                return False
+            continue
+
+        if x.__class__ is not y.__class__ or x.returntype != y.returntype:
+            return False
+
+        # if we already know the hashes, they can tell us we're different
+        if x.cached_hash is not None and y.cached_hash is not None and x.cached_hash != y.cached_hash:
+            return False
+
+        if isinstance(x, BVAddFunctionNode):
+            if x._name != y._name or x.added_rule.bv_prefix != y.added_rule.bv_prefix or len(x._args) != len(y._args):
+                return False
+
+            # On a lambda, we must add the introduced bv, and then remove it again after the args
+            bvn = x.added_rule.bv_prefix+str(d)
+            x_bv_names[x.added_rule.name] = bvn
+            y_bv_names[y.added_rule.name] = bvn
+            stack.append((x.added_rule.name, y.added_rule.name))
+        else:
+            if isinstance(x, BVUseFunctionNode):
+                if x_bv_names.get(x._name, x._name) != y_bv_names.get(y._name, y._name):
+                    return False
+            elif x._name != y._name:
+                return False
+
+            if x._args is None or y._args is None:
+                if x._args is not y._args:
+                    return False
+                continue
+
+            if len(x._args) != len(y._args):
+                return False
+
+        for a, b in zip(x._args, y._args):
+            stack.append((a, b, d+1))
+
+    return True
+
+
+def pystring(x, d=0, bv_names=None, bv_key=None):
     """Output a string that can be evaluated by python; gives bound variables names based on their depth.
 
     Args:
         bv_names: A dictionary from the uuids to nicer names.
+        bv_key: bv_names as a tuple of (uuid, name) in the order they were added. Each node memoizes its string
+            under d and bv_key, so rendering a tree again only re-renders what changed. If bv_names is given
+            without bv_key, nothing is memoized.
 
     """
     if isinstance(x, str):
@@ -886,50 +1343,56 @@ def pystring(x, d=0, bv_names=None):
     elif isFunctionNode(x):
 
         if bv_names is None:
-            bv_names = dict()
+            bv_names, bv_key = dict(), ()
+
+        if bv_key is not None and x.cached_pystring is not None and x.cached_depth == d and x.cached_bv_key == bv_key:
+            return x.cached_pystring
 
         bvn = '' # used when lambda but not BVAddFunctionNode
+        below_key = bv_key
         if isinstance(x, BVAddFunctionNode):
             bvn = x.added_rule.bv_prefix+str(d)
             bv_names[x.added_rule.name] = bvn
-            # assert len(x.args) == 1
+            if bv_key is not None:
+                below_key = bv_key + ((x.added_rule.name, bvn),)
+            # assert len(x._args) == 1
 
 
         # Now handle the name special cases
-        if x.args is None: # terminal
+        if x._args is None: # terminal
             if isinstance(x, BVUseFunctionNode):
-                ret = bv_names.get(x.name, x.name)
+                ret = bv_names.get(x._name, x._name)
             else:
-                ret = x.name
-        elif x.name == '':
-            assert len(x.args) == 1, "Null names must have exactly 1 argument"
-            ret = pystring(x.args[0], d=d+1, bv_names=bv_names)
+                ret = x._name
+        elif x._name == '':
+            assert len(x._args) == 1, "Null names must have exactly 1 argument"
+            ret = pystring(x._args[0], d=d+1, bv_names=bv_names, bv_key=below_key)
 
-        elif percent_s_regex.search(x.name): # If we match the python string substitution character %s, then format
-            ret = x.name % tuple(map(lambda a: pystring(a, d=d+1, bv_names=bv_names), x.args))
+        elif percent_s_regex.search(x._name): # If we match the python string substitution character %s, then format
+            ret = x._name % tuple([pystring(a, d=d+1, bv_names=bv_names, bv_key=below_key) for a in x._args])
 
-        elif x.name == 'lambda': # we are a lambda but NOT a BVAddFunctionNode -- a lambda thunk!
-                assert len(x.args) == 1
-                ret = 'lambda %s: %s' % (bvn, pystring(x.args[0], d=d+1, bv_names=bv_names))
+        elif x._name == 'lambda': # we are a lambda but NOT a BVAddFunctionNode -- a lambda thunk!
+                assert len(x._args) == 1
+                ret = 'lambda %s: %s' % (bvn, pystring(x._args[0], d=d+1, bv_names=bv_names, bv_key=below_key))
         else:
 
-            name = x.name
+            name = x._name
             if isinstance(x, BVUseFunctionNode): # handle bv functions
-                name = bv_names.get(x.name, x.name)
+                name = bv_names.get(x._name, x._name)
 
-            ret = name+'('+', '.join(map(lambda a: pystring(a, d=d+1, bv_names=bv_names), x.args))+')'
+            ret = name+'('+', '.join([pystring(a, d=d+1, bv_names=bv_names, bv_key=below_key) for a in x._args])+')'
 
         # and if we have any bv matches, then insert the bv we introduce
-        if bv_regex.search(ret):
+        if '<BV>' in ret:
             ret = bv_regex.sub(bvn, ret)
 
         # On a lambda, we must add the introduced bv, and then remove it again afterwards
         if isinstance(x, BVAddFunctionNode):
             del bv_names[x.added_rule.name]
 
-        return ret
-
-
-
-
+        if bv_key is not None:
+            if x.cached_depth != d or x.cached_bv_key != bv_key: # we were rendered somewhere else before
+                x.cached_depth, x.cached_bv_key, x.cached_fullstring = d, bv_key, None
+            x.cached_pystring = ret
 
+        return ret
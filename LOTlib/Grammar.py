@@ -6,28 +6,119 @@ except ImportError: import numpypy as np
 from copy import copy
 from collections import defaultdict
 import itertools
+from bisect import bisect_right
 
 from LOTlib.Miscellaneous import *
 from LOTlib.GrammarRule import GrammarRule, BVAddGrammarRule
 from LOTlib.BVRuleContextManager import BVRuleContextManager
+from LOTlib.BVContext import BVContext
+from LOTlib.CompiledGrammar import CompiledGrammar
+from LOTlib.FlatTree import FlatTree
 from LOTlib.FunctionNode import FunctionNode, BVAddFunctionNode
 
 
 # when we pack, we are allowed to use these characters, in this order
 import string
 pack_string = '0123456789'+string.ascii_lowercase+string.ascii_uppercase
+pack_index = dict((c, i) for i, c in enumerate(pack_string))
+
+
+def pack_varints(ints):
+    """Encode a list of non-negative ints as a string of bytes, seven bits per byte, with the high bit set on
+    every byte but the last of each int (as in protocol buffers)."""
+    out = []
+    for i in ints:
+        while i >= 128:
+            out.append(chr(128 | (i & 127)))
+            i >>= 7
+        out.append(chr(i))
+    return ''.join(out)
+
+
+def unpack_varints(s):
+    """Decode a string from pack_varints into a list of ints."""
+    out = []
+    i, shift = 0, 0
+    for c in s:
+        b = ord(c)
+        i |= (b & 127) << shift
+        if b < 128:
+            out.append(i)
+            i, shift = 0, 0
+        else:
+            shift += 7
+    assert shift == 0, "*** Truncated varint in %r" % s
+    return out
+
+
+def sample_index(weights):
+    """Sample an index into weights in proportion to its (unnormalized, nonnegative) weight."""
+    cumulative = []
+    total = 0.0
+    for w in weights:
+        total += w
+        cumulative.append(total)
+    assert total > 0.0, "*** Cannot sample from weights that are all zero"
+
+    i = bisect_right(cumulative, random() * total)
+    if i >= len(weights):  # only by rounding, so take the last index that has any weight
+        i = max([j for j, w in enumerate(weights) if w > 0.0])
+    return i
+
+
+class GenerationBudgetException(Exception):
+    """Raised when Grammar.generate would exceed its max_depth or max_nodes."""
+    pass
 
 
 class Grammar(CommonEqualityMixin):
     """
     A PCFG-ish class that can handle rules that introduce bound variables
+
+    If de_bruijn, each lambda's bound variable is named by its level, the number of lambdas above it (see
+    FunctionNode.bv_level_name), rather than by a new uuid. Trees then have the same names (and so the same strings
+    and memoized strings) wherever they are made, and generating them is cheaper; but a lambda inserted or deleted
+    above a subtree means renaming the bound variables in it (FunctionNode.renumber_bv).
     """
-    def __init__(self, BV_P=10.0, start='START'):
+    # These are derived from self.rules (or are bound variables in scope), and so are skipped when comparing grammars
+    NoCompare = {'version', 'compiled', 'signature_index', 'log_normalizers', 'enumeration_counts',
+                 'size_probabilities', 'rule_changes', 'bv', 'frozen'}
+
+    def __init__(self, BV_P=10.0, start='START', de_bruijn=False):
         self_update(self,locals())
         self.rules = defaultdict(list)  # A dict from nonterminals to lists of GrammarRules.
+        self.version = 0  # incremented whenever the rules or their probabilities change
+        self.compiled = None  # the CompiledGrammar for this version, made by compile()
+        self.signature_index = defaultdict(dict)  # nonterminal -> rule signature -> list of GrammarRules with it
+        self.log_normalizers = dict()  # nonterminal -> log of the summed rule probabilities, computed lazily
+        self.enumeration_counts = dict()  # memoized count_at_depth
+        self.size_probabilities = dict()  # memoized size_probability and children_size_probability
+        self.rule_changes = GrammarRule.changes  # see check_rule_changes
+        self.bv = BVContext()  # the bound variable rules currently added; these are not in self.rules
+        self.frozen = False  # see freeze()
         self.rule_count = 0
         self.bv_count = 0   # How many rules in the grammar introduce bound variables?
 
+    def __eq__(self, other):
+        if not isinstance(other, self.__class__):
+            return False
+        keys = set(self.__dict__.keys()) | set(other.__dict__.keys())
+        return all(self.__dict__.get(k) == other.__dict__.get(k) for k in keys - Grammar.NoCompare)
+
+    def __setstate__(self, state):
+        """ Grammars pickled before the caches existed must have them rebuilt """
+        self.__dict__.update(state)
+        self.__dict__.setdefault('version', 0)
+        self.__dict__.setdefault('rule_changes', GrammarRule.changes)
+        self.__dict__.setdefault('bv', BVContext())
+        self.__dict__.setdefault('de_bruijn', False)
+        frozen, self.frozen = state.get('frozen', False), False
+        if 'signature_index' not in state:
+            self.index_rules()
+        self.invalidate_caches()
+        if frozen:
+            self.freeze()
+
     def __str__(self):
         """Display a grammar."""
         return '\n'.join([str(r) for r in itertools.chain(*[self.rules[nt] for nt in self.rules.keys()])])
@@ -37,11 +128,19 @@ class Grammar(CommonEqualityMixin):
         """
         return sum([len(self.rules[nt]) for nt in self.rules.keys()])
 
-    def get_rules(self, nt):
+    def get_rules(self, nt, context=None):
         """
-        The possible rules for any nonterminal
+        The possible rules for any nonterminal, including the bound variable rules in context (default self.bv)
         """
-        return self.rules[nt]
+        if context is None:
+            context = self.bv
+
+        rules = self.rules[nt] if nt in self.rules else []
+        bv = context.rules.get(nt)
+        if bv:
+            return rules + bv
+        else:
+            return rules
 
     def get_all_rules(self):
         """
@@ -51,10 +150,12 @@ class Grammar(CommonEqualityMixin):
             for r in self.get_rules(nt):
                 yield r
 
-    def is_nonterminal(self, x):
-        """A nonterminal is just something that is a key for self.rules"""
+    def is_nonterminal(self, x, context=None):
+        """A nonterminal is just something that is a key for self.rules (or has bound variable rules in context)"""
+        if context is None:
+            context = self.bv
         # if x is a string  &&  if x is a key
-        return isinstance(x, str) and (x in self.rules)
+        return isinstance(x, str) and (x in self.rules or x in context.p)
 
     def display_rules(self):
         """Prints all the rules to the console."""
@@ -63,54 +164,199 @@ class Grammar(CommonEqualityMixin):
 
     def __iter__(self):
         """Define an iterator over all rules so we can say 'for rule in grammar...'."""
-        for k in self.rules.keys():
-            for r in self.rules[k]:
-                yield r
+        return self.get_all_rules()
 
     def nonterminals(self):
         """Returns all non-terminals."""
-        return self.rules.keys()
+        return self.rules.keys() + [nt for nt in self.bv.p if nt not in self.rules]
+
+    def index_rules(self):
+        """
+        Rebuild self.signature_index from self.rules. This is only needed if self.rules is modified directly
+        instead of through add_rule. Bound variable rules are looked up in self.bv instead.
+        """
+        self.signature_index = defaultdict(dict)
+        for nt in self.rules.keys():
+            for r in self.rules[nt]:
+                self.signature_index[nt].setdefault(r.get_rule_signature(), []).append(r)
 
-    def get_matching_rule(self, t):
+    def invalidate_caches(self, nt=None):
+        """
+        Forget the cached normalizers for nt (or for every nonterminal if nt is None). add_rule and renormalize
+        call this, as does check_rule_changes when a rule's p has been set directly.
+        """
+        assert not self.frozen, "*** Cannot change a frozen grammar"
+        self.version += 1
+        self.rule_changes = GrammarRule.changes
+        self.compiled = None
+        if nt is None:
+            self.log_normalizers = dict()
+        else:
+            self.log_normalizers.pop(nt, None)
+        self.enumeration_counts = dict()  # these depend on every nonterminal below
+        self.size_probabilities = dict()
+
+    def check_rule_changes(self):
+        """
+        Invalidate the caches if any rule's p has been set since they were made. GrammarRule only counts these
+        changes globally, so a change in another grammar's rules also invalidates ours; that is rare and only
+        costs recomputing them. A frozen grammar's rules must not change, so it is not checked.
         """
-        Get the rule matching t's signature. Note: We could probably speed this up with a hash table if need be.
+        if self.rule_changes != GrammarRule.changes and not self.frozen:
+            self.invalidate_caches()
+
+    def freeze(self):
+        """
+        Make this grammar immutable, so that one grammar can be shared (e.g. across threads) without copies.
+        The caches are all filled here, and after this, changing the grammar (add_rule, renormalize,
+        invalidate_caches) or pushing bound variables onto self.bv is an error. Instead, every method that
+        uses bound variables takes a context (a BVContext); when none is given, a new one is made for the call.
+        To change the grammar again, set self.frozen = False.
+        """
+        self.compile()
+        for nt in self.rules.keys():
+            self.log_normalizer(nt)
+        self.frozen = True
+
+    def get_context(self, context=None):
+        """
+        The BVContext to use for a call given context. If context is None, this is self.bv, unless we are
+        frozen, in which case it is a new one.
+        """
+        if context is not None:
+            return context
+        elif self.frozen:
+            return BVContext()
+        else:
+            return self.bv
+
+    def compile(self):
+        """
+        Return a CompiledGrammar for the current rules (not including bound variables). This is cached until
+        the grammar changes.
+        """
+        self.check_rule_changes()
+        if self.compiled is None:
+            self.compiled = CompiledGrammar(self)
+        return self.compiled
+
+    def log_normalizer(self, nt, context=None):
+        """
+        The log of the total probability of nt's rules, including any bound variable rules in context (default
+        self.bv). Only the normalizer without bound variables is cached, so it does not depend on the context.
+        """
+        if context is None:
+            context = self.bv
+
+        self.check_rule_changes()
+        z = self.log_normalizers.get(nt)
+        if z is None:
+            z = sum([r.p for r in self.rules.get(nt, [])])
+            z = log(z) if z > 0.0 else -Infinity
+            self.log_normalizers[nt] = z
+
+        bvp = context.p.get(nt)
+        if bvp is None:
+            return z
+        else:
+            return log(exp(z) + bvp)
+
+    def push_bv_rule(self, r):
+        """
+        Add a rule introduced by a bound variable (see BVRuleContextManager) to self.bv.
+        """
+        assert not self.frozen, "*** Frozen grammars must be given a BVContext instead of using self.bv"
+        self.bv.push(r)
+
+    def pop_bv_rule(self, r):
+        """
+        Remove a rule added by push_bv_rule. Rules must be removed in the reverse order they were added.
+        """
+        self.bv.pop(r)
+
+    def sample_rule(self, nt, context=None):
         """
-        rules = self.get_rules(t.returntype)
-        matching_rules = [r for r in rules if (r.get_rule_signature() == t.get_rule_signature())]
+        Sample one of nt's rules (including bound variable rules in context, default self.bv) in proportion to
+        its p.
+        """
+        if context is None:
+            context = self.bv
+
+        cg = self.compile()
+        cumulative, rules = cg.cumulative.get(nt), cg.rules.get(nt, ())
+        bv_rules = context.rules.get(nt, ())
+        assert len(rules) + len(bv_rules) > 0, "*** No rules in x=%s" % nt
+
+        z = cumulative[-1] if rules else 0.0
+        u = random() * (z + context.p.get(nt, 0.0))
+
+        if u < z:
+            return rules[min(bisect_right(cumulative, u), len(rules)-1)]
+        else:
+            # One of the (few) bound variable rules
+            u -= z
+            for r in bv_rules:
+                u -= r.p
+                if u < 0.0:
+                    return r
+            return bv_rules[-1]
+
+    def get_matching_rule(self, t, context=None):
+        """
+        Get the rule matching t's signature. This is a lookup in self.signature_index (or context, default
+        self.bv, for bound variables); we fall back to scanning the rules if that fails, which also handles
+        rules appended to self.rules directly.
+        """
+        if context is None:
+            context = self.bv
+
+        sig = t.get_rule_signature()
+        matching_rules = context.signatures.get(sig) or self.signature_index.get(t.returntype, {}).get(sig)
+        if matching_rules is not None and len(matching_rules) == 1:
+            return matching_rules[0]
+
+        rules = self.get_rules(t.returntype, context)
+        matching_rules = [r for r in rules if (r.get_rule_signature() == sig)]
         assert len(matching_rules) == 1, \
             "Grammar Error: " + str(len(matching_rules)) + " matching rules for this FunctionNode! %s %s %s" % (t.get_rule_signature(), str(t), matching_rules)
         return matching_rules[0]
 
-    def single_probability(self, t):
+    def single_probability(self, t, context=None):
         # in this tree, in its context (recursing up), what is the probability of this single expansion?
+        context = self.get_context(context)
 
-        with BVRuleContextManager(self, t, recurse_up=True):
-            z = log(sum([ r.p for r in self.get_rules(t.returntype) ]))
-            r = self.get_matching_rule(t)
+        with BVRuleContextManager(self, t, recurse_up=True, context=context):
+            z = self.log_normalizer(t.returntype, context)
+            r = self.get_matching_rule(t, context)
             return log(r.p)-z
 
-    def log_probability(self, t):
+    def log_probability(self, t, context=None):
         """
         Returns the log probability of t, recomputing everything (as we do now)
 
         This is overall about half as fast, but it means we don't have to store generation_probability
+
+        The bound variables above t must be in context (see get_context).
         """
         assert isinstance(t, FunctionNode)
-
-        z = log(sum([ r.p for r in self.get_rules(t.returntype) ]))
+        context = self.get_context(context)
 
         # Find the one that matches. While it may seem like we should store this, that is hard to make work
         # with multiple grammar objects across loading/saving, because the objects will change. This way,
         # we always look it up.
-        lp = -Infinity
-        r = self.get_matching_rule(t)
-        assert r is not None, "Failed to find matching rule at %s %s" % (t, r)
-
-        lp = log(r.p) - z
+        # If there are no bound variables for this nonterminal, the compiled grammar has the log probability
+        cg = self.compile()
+        i = cg.rule_id(t)
+        if i is not None and t.returntype not in context.p:
+            lp = cg.log_p[t.returntype].item(i)
+        else:
+            r = self.get_matching_rule(t, context)
+            assert r is not None, "Failed to find matching rule at %s %s" % (t, r)
+            lp = log(r.p) - self.log_normalizer(t.returntype, context)
 
-        with BVRuleContextManager(self, t):
+        with BVRuleContextManager(self, t, context=context):
             for a in t.argFunctionNodes():
-                lp += self.log_probability(a)
+                lp += self.log_probability(a, context)
 
         return lp
 
@@ -126,6 +372,7 @@ class Grammar(CommonEqualityMixin):
             bv_args (list): What are the args when we use a bv (None is terminals, else a type signature)
 
         """
+        assert not self.frozen, "*** Cannot change a frozen grammar"
         self.rule_count += 1
         assert name is not None, "To use null names, use an empty string ('') as the name."
         if bv_type is not None:
@@ -134,73 +381,118 @@ class Grammar(CommonEqualityMixin):
             newrule = GrammarRule(nt, name, to, p=p)
 
         self.rules[nt].append(newrule)
+        self.signature_index[nt].setdefault(newrule.get_rule_signature(), []).append(newrule)
+        self.invalidate_caches(nt)
         return newrule
     
-    def is_terminal_rule(self, r):
+    def is_terminal_rule(self, r, context=None):
         """
         Check if a rule is "terminal" - meaning that it doesn't contain any nonterminals in its expansion.
         """ 
-        return not any([self.is_nonterminal(a) for a in None2Empty(r.to)])  
+        return not any([self.is_nonterminal(a, context) for a in None2Empty(r.to)])
 
 
     # --------------------------------------------------------------------------------------------------------
     # Generation
     # --------------------------------------------------------------------------------------------------------
 
-    def generate(self, x=None):
+    def generate(self, x=None, max_depth=None, max_nodes=None, context=None):
         """Generate from the grammar
 
         Arguments:
             x (string): What we start from -- can be None and then we use Grammar.start.
+            max_depth (int): if not None, raise a GenerationBudgetException as soon as we would make a node
+              deeper than this (the root has depth 0, as in FunctionNode.depth)
+            max_nodes (int): if not None, raise a GenerationBudgetException as soon as the tree would have more
+              than this many FunctionNodes (as in FunctionNode.count_nodes)
+            context (BVContext): the bound variables in scope (see get_context)
+
+        Note:
+            This uses an explicit stack rather than recursion, so deep trees do not hit python's recursion limit.
+            Nodes are expanded in preorder and each bound variable rule is in the grammar while the nodes below
+            its lambda are generated, exactly as in recursive generation. If x is a list, we map along it, with
+            the budgets applying to each element separately.
 
         """
-        # print "# Calling Grammar.generate", type(x), x
-
         # Decide what to start from based on the default if start is not specified
         if x is None:
             x = self.start
             assert self.start in self.nonterminals(), \
                 "The default start symbol %s is not a defined nonterminal" % self.start
 
-        # Dispatch different kinds of generation
-        if isinstance(x,list):            
-            return map(lambda xi: self.generate(x=xi), x)             # If we get a list, just map along it to generate.
-        elif self.is_nonterminal(x):
-
-            # sample a grammar rule
-            rules = self.get_rules(x)
-            assert len(rules) > 0, "*** No rules in x=%s"%x
+        context = self.get_context(context)
+        return self.expand(x, lambda nt: self.sample_rule(nt, context), max_depth=max_depth, max_nodes=max_nodes,
+                           context=context)
 
-            # sample the rule
-            r = weighted_sample(rules, probs=lambda x: x.p, log=False)
+    def expand(self, x, choose, max_depth=None, max_nodes=None, context=None):
+        """Make a tree from x, using choose(nt) to pick the rule for each nonterminal nt, in preorder. This is
+        generate, except for how rules are picked; see generate for the arguments.
 
-            # Make a stub for this functionNode 
-            fn = r.make_FunctionNodeStub(self, None)
-
-            # Define a new context that is the grammar with the rule added
-            # Then, when we exit, it's still right.
-            with BVRuleContextManager(self, fn, recurse_up=False):      # not sure why we can't use with/as:
-                # Can't recurse on None or else we genreate from self.start
-                if fn.args is not None:
-                    # and generate below *in* this context (e.g. with the new rules added)
-                    try:
-                        fn.args = self.generate(fn.args)
-                    except RuntimeError as e:
-                        print "*** Runtime error in %s" % fn
-                        raise e
-
-
-                # and set the parents
-                for a in fn.argFunctionNodes():
-                    a.parent = fn
-
-            return fn
+        Note:
+            While choose is called, the bound variable rules from the lambdas above the node being made are the
+            last entries on context.stack, outermost first.
+        """
+        context = self.get_context(context)
 
-        else:  # must be a terminal
+        # Dispatch different kinds of generation
+        if isinstance(x, list):
+            return [self.expand(xi, choose, max_depth=max_depth, max_nodes=max_nodes, context=context) for xi in x]
+        elif not self.is_nonterminal(x, context):
             assert isinstance(x, str), ("*** Terminal must be a string! x="+x)
             return x
 
-    def enumerate(self, d=20, nt=None, leaves=True):
+        root = choose(x).make_FunctionNodeStub(self, None, context)
+        nnodes = 1
+        if max_nodes is not None and nnodes > max_nodes:
+            raise GenerationBudgetException
+
+        # Each stack frame is [node, index of the next arg to expand, depth]
+        stack = []
+        try:
+            if root.added_rule is not None:
+                context.push(root.added_rule)
+            stack.append([root, 0, 0])
+
+            while stack:
+                frame = stack[-1]
+                fn, i, d = frame
+
+                if fn.args is None or i == len(fn.args):
+                    # done with fn, so remove its bound variable (if any) before moving back up
+                    stack.pop()
+                    if fn.added_rule is not None:
+                        context.pop(fn.added_rule)
+                    continue
+
+                frame[1] = i+1
+                a = fn.args[i]
+                if not self.is_nonterminal(a, context):
+                    continue  # a terminal stays as a string
+
+                if max_depth is not None and d+1 > max_depth:
+                    raise GenerationBudgetException
+                nnodes += 1
+                if max_nodes is not None and nnodes > max_nodes:
+                    raise GenerationBudgetException
+
+                # Make a stub below fn, and put it on the stack to expand its args in its context
+                child = choose(a).make_FunctionNodeStub(self, fn, context)
+                fn.args[i] = child
+                if child.added_rule is not None:
+                    context.push(child.added_rule)
+                stack.append([child, 0, d+1])
+
+        except:
+            # leave the grammar as we found it (in particular, when we go over budget)
+            while stack:
+                fn = stack.pop()[0]
+                if fn.added_rule is not None:
+                    context.pop(fn.added_rule)
+            raise
+
+        return root
+
+    def enumerate(self, d=20, nt=None, leaves=True, worker=0, nworkers=1, context=None):
         """Enumerate all trees up to depth n.
 
         Parameters:
@@ -208,13 +500,16 @@ class Grammar(CommonEqualityMixin):
             nt (str): the nonterminal type
             leaves (bool): do we put terminals in the leaves or leave nonterminal types? This is useful in
               PartitionMCMC
+            worker, nworkers (int): only yield this worker's share of the trees at each depth (see
+              enumerate_at_depth)
 
         """
         for i in infrange(d):
-            for t in self.enumerate_at_depth(i, nt=nt, leaves=leaves):
+            for t in self.enumerate_at_depth(i, nt=nt, leaves=leaves, worker=worker, nworkers=nworkers,
+                                             context=context):
                 yield t
 
-    def enumerate_at_depth(self, d, nt=None, leaves=True):
+    def enumerate_at_depth(self, d, nt=None, leaves=True, worker=0, nworkers=1, context=None):
         """Generate trees at depth d, no deeper or shallower.
 
         Parameters
@@ -222,73 +517,187 @@ class Grammar(CommonEqualityMixin):
             nt (str): the type of the nonterminal you want to return (None reverts to self.start)
             leaves (bool): do we put terminals in the leaves or leave nonterminal types? This is useful in
               PartitionMCMC. This returns trees of depth d-1!
+            worker, nworkers (int): split the trees into nworkers contiguous blocks (by rank) and only yield
+              block number worker. Running workers 0..nworkers-1 yields every tree exactly once.
 
         Return:
-            yields the ...
+            yields the trees, in order of their rank (see unrank_at_depth)
 
         """
         if nt is None:
             nt = self.start
+        context = self.get_context(context)
+
+        n = self.count_at_depth(d, nt=nt, leaves=leaves, context=context)
+        for t in self.enumerate_rank_range(nt, d, leaves, worker*n // nworkers, (worker+1)*n // nworkers,
+                                            context):
+            # enumerate_rank_range shares subtrees between the trees it yields, so each must be copied
+            yield copy(t)
+
+    def unrank_at_depth(self, k, d, nt=None, leaves=True, context=None):
+        """Return the k'th tree that enumerate_at_depth(d, nt, leaves) would yield, without enumerating the
+        ones before it.
+        """
+        if nt is None:
+            nt = self.start
+        context = self.get_context(context)
+
+        assert 0 <= k < self.count_at_depth(d, nt=nt, leaves=leaves, context=context), \
+            "*** Rank %s out of range" % k
+        for t in self.enumerate_rank_range(nt, d, leaves, k, k+1, context):
+            return copy(t)
+
+    def count_at_depth(self, d, nt=None, leaves=True, context=None):
+        """How many trees would enumerate_at_depth(d, nt, leaves) yield?
 
-        # handle garbage that may be passed in here
-        if not self.is_nonterminal(nt):
+        This is computed by dynamic programming over the rules, and memoized for each nonterminal, depth, and
+        set of bound variable rules in context.
+        """
+        if nt is None:
+            nt = self.start
+        context = self.get_context(context)
+
+        if not self.is_nonterminal(nt, context):
+            return 1  # a terminal just yields itself
+        if d < 0:
+            return 0
+
+        self.check_rule_changes()
+        key = (nt, d, leaves, context.key())
+        n = self.enumeration_counts.get(key)
+        if n is None:
+            if d == 0:
+                n = len([r for r in self.get_rules(nt, context) if self.is_terminal_rule(r, context)]) if leaves else 1
+            else:
+                n = sum([self.count_rule_at_depth(r, d, leaves, context) for r in self.get_rules(nt, context)
+                         if not self.is_terminal_rule(r, context)])
+            self.enumeration_counts[key] = n
+        return n
+
+    def count_rule_at_depth(self, r, d, leaves=True, context=None):
+        """How many trees of depth d have r at their root?"""
+        context = self.get_context(context)
+        bv = r.make_bv_rule(self, len(context)) if isinstance(r, BVAddGrammarRule) else None
+        if bv is not None:
+            context.push(bv)
+        try:
+            # how many ways can each child be at most depth k?
+            def at_most(k):
+                return [sum([self.count_at_depth(j, a, leaves, context) for j in xrange(k+1)])
+                        if self.is_nonterminal(a, context)
+                        else int(k >= 0) for a in r.to]
+
+            # and subtract the ways that none reach depth d-1
+            return reduce(lambda x, y: x*y, at_most(d-1), 1) - reduce(lambda x, y: x*y, at_most(d-2), 1)
+        finally:
+            if bv is not None:
+                context.pop(bv)
+
+    def enumerate_rank_range(self, nt, d, leaves, lo, hi, context=None):
+        """Yield the trees of depth d from nt whose ranks are in [lo, hi), skipping all of the others by using
+        the counts.
+
+        The order (i.e. rank) is the rules in order, then each combination of child depths (the first child's
+        depth varying fastest), then each combination of children (again the first varying fastest).
+
+        NOTE: The yielded trees share subtrees with each other and do not have correct parent references, so
+        they must be copied. Also, as in all enumeration, bound variable rules are only in context while we are
+        working inside a lambda, and never while we are yielding.
+        """
+        if lo >= hi:
+            return
+        context = self.get_context(context)
+
+        if not self.is_nonterminal(nt, context):
             yield nt
-            raise StopIteration
+            return
 
         if d == 0:
             if leaves:
                 # Note: can NOT use filter here, or else it doesn't include added rules
-                for r in self.rules[nt]:
-                    if self.is_terminal_rule(r):
-                        yield r.make_FunctionNodeStub(self, None)
+                terminals = [r for r in self.get_rules(nt, context) if self.is_terminal_rule(r, context)]
+                for r in terminals[lo:hi]:
+                    yield r.make_FunctionNodeStub(self, None, context)
             else:
                 # If not leaves, we just put the nonterminal type in the leaves
                 yield nt
-        else:
-            # Note: can NOT use filter here, or else it doesn't include added rules. No sorting either!
-            for r in self.rules[nt]:
-
-                # No good since it won't be deep enough
-                if self.is_terminal_rule(r):
-                    continue
-
-
-                fn = r.make_FunctionNodeStub(self, None)
-
-                # The possible depths for the i'th child
-                # Here we just ensure that nonterminals vary up to d, and otherwise
-                child_i_depths = lambda i: xrange(d) if self.is_nonterminal(fn.args[i]) else [0]
-
-                # The depths of each kid
-                for cd in lazyproduct(map(child_i_depths, xrange(len(fn.args))), child_i_depths):
-
-                    # One must be equal to d-1
-                    # TODO: can be made more efficient via permutations. Also can skip terminals in args.
-                    if max(cd) < d-1:
-                        continue
-                    assert max(cd) == d-1
-
-                    myiter = lazyproduct(
-                        [self.enumerate_at_depth(di, nt=a, leaves=leaves) for di, a in zip(cd, fn.args)],
-                        lambda i: self.enumerate_at_depth(cd[i], nt=fn.args[i], leaves=leaves))
-                    try:
-                        while True:
-                            # Make a copy so we don't modify anything
-                            yieldfn = copy(fn)
-
-                            # BVRuleContextManager here makes us remove the rule BEFORE yielding,
-                            # or else this will be incorrect. Wasteful but necessary.
-                            with BVRuleContextManager(self, fn, recurse_up=False):
-                                yieldfn.args = myiter.next()
-                                for a in yieldfn.argFunctionNodes():
-                                    # Update parents
-                                    a.parent = yieldfn
-
-                            yield copy(yieldfn)
-
-                    except StopIteration:
-                        # Catch this here so we continue in this loop over rules
-                        pass
+            return
+
+        offset = 0  # the rank of the first tree from the current rule and child depths
+        # Note: no sorting, and we must copy since we push bound variables onto the list
+        for r in list(self.get_rules(nt, context)):
+            if offset >= hi:
+                return
+
+            if self.is_terminal_rule(r, context):
+                continue  # No good since it won't be deep enough
+
+            n = self.count_rule_at_depth(r, d, leaves, context)
+            if offset + n <= lo:
+                offset += n
+                continue
+
+            fn = r.make_FunctionNodeStub(self, None, context)
+            for cd in self.child_depth_combinations(fn.args, d, context):
+
+                # how many choices are there for each child at these depths?
+                if fn.added_rule is not None:
+                    context.push(fn.added_rule)
+                sizes = [self.count_at_depth(di, a, leaves, context) for di, a in zip(cd, fn.args)]
+                if fn.added_rule is not None:
+                    context.pop(fn.added_rule)
+
+                n = reduce(lambda x, y: x*y, sizes, 1)
+                if n > 0 and offset + n > lo:
+                    children = self.enumerate_product_range(zip(fn.args, cd), sizes, leaves,
+                                                            max(lo-offset, 0), min(hi-offset, n), context)
+                    while True:
+                        # Only have the bound variable in the grammar while we make the children
+                        if fn.added_rule is not None:
+                            context.push(fn.added_rule)
+                        try:
+                            args = next(children, None)
+                        finally:
+                            if fn.added_rule is not None:
+                                context.pop(fn.added_rule)
+
+                        if args is None:
+                            break
+
+                        t = fn.__copy__(shallow=True)
+                        t.args = args
+                        yield t
+
+                offset += n
+                if offset >= hi:
+                    return
+
+    def enumerate_product_range(self, children, sizes, leaves, lo, hi, context=None):
+        """Yield the lists of subtrees for children (a list of (nonterminal, depth)) with ranks in [lo, hi),
+        where the first child varies fastest. sizes gives the number of choices for each child.
+        """
+        if len(children) == 0:
+            if lo == 0 and hi > 0:
+                yield []
+            return
+
+        # the ranks are mixed-radix numbers, so we pick out the last (slowest) child's range and recurse on the rest
+        inner = reduce(lambda x, y: x*y, sizes[:-1], 1)
+        nt, d = children[-1]
+        first = lo // inner
+        for j, t in enumerate(self.enumerate_rank_range(nt, d, leaves, first, (hi-1) // inner + 1, context), first):
+            for rest in self.enumerate_product_range(children[:-1], sizes[:-1], leaves,
+                                                     max(lo - j*inner, 0), min(hi - j*inner, inner), context):
+                yield rest + [t]
+
+    def child_depth_combinations(self, args, d, context=None):
+        """Yield each combination of depths for args in a tree of depth d, with the first varying fastest.
+        Nonterminals can be anything up to d-1, terminals only 0, and at least one must be exactly d-1.
+        """
+        depths = [range(d) if self.is_nonterminal(a, context) else [0] for a in args]
+        for cd in itertools.product(*reversed(depths)):
+            if max(cd) == d-1:
+                yield tuple(reversed(cd))
 
     def depth_to_terminal(self, x, openset=None, current_d=None):
         """
@@ -335,6 +744,193 @@ class Grammar(CommonEqualityMixin):
             for r in self.get_rules(nt):
                 r.p = r.p / z
 
+        self.invalidate_caches()
+
+
+    # --------------------------------------------------------------------------------------------------------
+    # Tree sizes
+    # How big are the trees we generate? Sizes are numbers of FunctionNodes, as in FunctionNode.count_nodes
+    # --------------------------------------------------------------------------------------------------------
+
+    def termination_probabilities(self, tol=1e-12, max_iterations=100000):
+        """
+        The probability that generating from each nonterminal ever finishes, as a dict. This is the least fixed
+        point of q[nt] = sum_r p(r) * prod_{a in r.to} q[a], found by iterating from q = 0. If this is less than
+        one, the grammar is not proper (it puts mass on infinite trees).
+
+        Bound variables are not included (these are for the grammar's own rules).
+        """
+        q = dict((nt, 0.0) for nt in self.rules.keys())
+        for _ in xrange(max_iterations):
+            newq = dict()
+            for nt in self.rules.keys():
+                z = sum([r.p for r in self.rules[nt]])
+                newq[nt] = sum([r.p / z * reduce(lambda x, y: x*y, [q[a] for a in None2Empty(r.to) if a in q], 1.0)
+                                for r in self.rules[nt]])
+            done = max([abs(newq[nt] - q[nt]) for nt in q] + [0.0]) < tol
+            q = newq
+            if done:
+                break
+        return q
+
+    def expected_sizes(self):
+        """
+        The expected size of a tree from each nonterminal, as a dict. This solves E = 1 + M E, where M[nt][a] is
+        the expected number of a's among nt's children; nonterminals that can reach a part of the grammar where
+        this has no finite solution get Infinity.
+
+        Bound variables are not included (these are for the grammar's own rules).
+        """
+        nts = self.rules.keys()
+        idx = dict((nt, i) for i, nt in enumerate(nts))
+        M = np.zeros((len(nts), len(nts)))
+        for nt in nts:
+            z = sum([r.p for r in self.rules[nt]])
+            for r in self.rules[nt]:
+                for a in None2Empty(r.to):
+                    if a in idx:
+                        M[idx[nt], idx[a]] += r.p / z
+
+        out = dict()
+        for nt in nts:
+            # the nonterminals that nt can reach (including itself)
+            reach, todo = {idx[nt]}, [idx[nt]]
+            while todo:
+                i = todo.pop()
+                for j in np.nonzero(M[i])[0]:
+                    if j not in reach:
+                        reach.add(j)
+                        todo.append(j)
+            sub = sorted(reach)
+            Msub = M[np.ix_(sub, sub)]
+
+            if max(abs(np.linalg.eigvals(Msub))) < 1.0:
+                E = np.linalg.solve(np.eye(len(sub)) - Msub, np.ones(len(sub)))
+                out[nt] = E[sub.index(idx[nt])]
+            else:
+                out[nt] = Infinity
+        return out
+
+    def size_probability(self, nt, n, context=None):
+        """
+        The probability that a tree generated from nt (in context) has exactly n nodes. This is computed by
+        dynamic programming over sizes (each child is smaller than its parent) and memoized for each
+        nonterminal, size, and context.
+        """
+        context = self.get_context(context)
+
+        if not self.is_nonterminal(nt, context):
+            return 1.0 if n == 0 else 0.0  # a terminal is not a node
+        if n <= 0:
+            return 0.0
+
+        self.check_rule_changes()
+        key = (nt, n, context.key())
+        p = self.size_probabilities.get(key)
+        if p is None:
+            z = exp(self.log_normalizer(nt, context))
+            p = sum([r.p / z * self.rule_size_probability(r, n-1, context) for r in self.get_rules(nt, context)])
+            self.size_probabilities[key] = p
+        return p
+
+    def rule_size_probability(self, r, s, context=None):
+        """
+        The probability that the children of a node made by r (in context) have s nodes in total
+        """
+        context = self.get_context(context)
+        bv = r.make_bv_rule(self, len(context)) if isinstance(r, BVAddGrammarRule) else None
+        if bv is not None:
+            context.push(bv)
+        try:
+            return self.children_size_probability(None2Empty(r.to), 0, s, context)
+        finally:
+            if bv is not None:
+                context.pop(bv)
+
+    def children_size_probability(self, to, i, s, context=None):
+        """
+        The probability that children to[i:] (already in their context) have s nodes in total
+        """
+        context = self.get_context(context)
+
+        if i == len(to):
+            return 1.0 if s == 0 else 0.0
+
+        self.check_rule_changes()
+        key = (tuple(to), i, s, context.key())
+        p = self.size_probabilities.get(key)
+        if p is None:
+            p = sum([self.size_probability(to[i], k, context) * self.children_size_probability(to, i+1, s-k, context)
+                     for k in xrange(s+1)])
+            self.size_probabilities[key] = p
+        return p
+
+    def size_mass(self, nt, maxnodes, context=None):
+        """ The probability that a tree generated from nt (in context) has at most maxnodes nodes """
+        context = self.get_context(context)
+        return sum([self.size_probability(nt, n, context) for n in xrange(maxnodes+1)])
+
+    def mass_above(self, nt, maxnodes, context=None):
+        """ The probability that a tree generated from nt (in context) has more than maxnodes nodes """
+        return max(1.0 - self.size_mass(nt, maxnodes, context=context), 0.0)
+
+    def generate_within(self, x=None, maxnodes=25, context=None):
+        """
+        Generate from x conditioned on the tree having at most maxnodes nodes. This is exact (not rejection):
+        we sample the size from the size distribution and then a tree of that size, so no oversized tree is
+        ever built. The probability of the result is log_probability_within(t, maxnodes).
+
+        Raises a GenerationBudgetException if no tree from x is small enough.
+        """
+        if x is None:
+            x = self.start
+        context = self.get_context(context)
+
+        if not self.is_nonterminal(x, context):
+            return x
+
+        sizes = [self.size_probability(x, n, context) for n in xrange(maxnodes+1)]
+        if sum(sizes) <= 0.0:
+            raise GenerationBudgetException
+
+        n = sample_index(sizes)
+        return self.generate_size(x, n, context=context)
+
+    def generate_size(self, x, n, parent=None, context=None):
+        """
+        Generate a tree with exactly n nodes from x (below parent), with probability proportional to its
+        generation probability.
+        """
+        context = self.get_context(context)
+
+        if not self.is_nonterminal(x, context):
+            assert n == 0
+            return x
+
+        rules = self.get_rules(x, context)
+        r = rules[sample_index([r.p * self.rule_size_probability(r, n-1, context) for r in rules])]
+
+        fn = r.make_FunctionNodeStub(self, parent, context)
+        with BVRuleContextManager(self, fn, context=context):
+            s = n-1  # the nodes left for fn.args[i:]
+            for i, a in enumerate(None2Empty(fn.args)):
+                k = sample_index([self.size_probability(a, k, context) *
+                                  self.children_size_probability(r.to, i+1, s-k, context) for k in xrange(s+1)])
+                fn.args[i] = self.generate_size(a, k, parent=fn, context=context)
+                s -= k
+
+        return fn
+
+    def log_probability_within(self, t, maxnodes, context=None):
+        """
+        The log probability that generate_within(t.returntype, maxnodes) gives t (with the bound variables above
+        t in context)
+        """
+        context = self.get_context(context)
+        if t.count_nodes() > maxnodes:
+            return -Infinity
+        return self.log_probability(t, context) - log(self.size_mass(t.returntype, maxnodes, context))
+
 
     # --------------------------------------------------------------------------------------------------------
     # Packing and unpacking trees
@@ -347,8 +943,11 @@ class Grammar(CommonEqualityMixin):
         Compute a dictionary from signatures to rule indices
         this is so that when we add rules for bound variables, we don't
         change all the rule indices.
-        NOTE: This step is slow and should be cached for a grammar
+        NOTE: Outside of bound variables, this is a copy of compile().sig2idx
         """
+        if len(self.bv) == 0:
+            return dict(self.compile().sig2idx)
+
         d = dict()
         idx = 0 # store the rule index, making each unique. NOTE: we could make it unique for each nt, but that may mess with LZPrior
 
@@ -363,6 +962,9 @@ class Grammar(CommonEqualityMixin):
         """
         Compute a dictionary from idx to rules that matches sig2idx
         """
+        if len(self.bv) == 0:
+            return dict(enumerate(self.compile().idx2rule))
+
         d = dict()
         idx = 0 # store the rule index, making each unique. NOTE: we could make it unique for each nt, but that may mess with LZPrior
 
@@ -373,92 +975,221 @@ class Grammar(CommonEqualityMixin):
 
         return d
 
-    def pack_ascii(self, t, sig2idx=None):
+    def pack_indices(self, t):
         """
-        Pack a tree into a simple ascii string, using grammar.
-        Not particularly optimized, but simple
+        Pack a tree into a list of rule indices (from compile().sig2idx), one for each node in preorder.
+        Below a lambda, its bound variable gets the next index after the grammar's rules (and after the
+        bound variables of any lambdas above it).
         """
+        cg = self.compile()
+        sig2idx = cg.sig2idx
+        bv = dict()  # signature -> index, for the bound variables we are below
 
-        if sig2idx is None:
-            sig2idx = self.sig2idx()
+        out = []
+        stack = [t]
+        while stack:
+            x = stack.pop()
 
+            if not isinstance(x, FunctionNode):
+                del bv[x.get_rule_signature()]  # x is the added rule of a lambda we are done with
+                continue
 
-        # the output string (starts empty)
-        s = ''
+            sig = x.get_rule_signature()
+            i = bv.get(sig)
+            out.append(sig2idx[sig] if i is None else i)
 
-        # compute the node's index (i.e. packed name)
-        # pack_string is a string, not a function
-        s = s + pack_string[sig2idx[t.get_rule_signature()]]
+            # add rule if we're adding a bound variable (i.e. a lambda), and mark when to remove it
+            if isinstance(x, BVAddFunctionNode):
+                bv[x.added_rule.get_rule_signature()] = len(cg.idx2rule) + len(bv)
+                stack.append(x.added_rule)
 
-        # add rule if we're adding a bound variable (i.e. a lambda)
-        if isinstance(t, BVAddFunctionNode):
-            r = t.added_rule
-            idx =  max(sig2idx.values())+1
-            sig2idx[r.get_rule_signature()] = idx
+            stack.extend(reversed(list(x.argFunctionNodes())))
 
-        # recurse
-        for a in t.argFunctionNodes():
-            s = s+self.pack_ascii(a, sig2idx=sig2idx)
+        return out
 
-        # remove bound variable rule after recursing
-        if isinstance(t, BVAddFunctionNode):
-            r = t.added_rule
-            del sig2idx[r.get_rule_signature()]
-            
-        return s
+    def unpack_indices(self, ids, x=None, context=None):
+        """
+        Unpack a list of indices from pack_indices into a tree, starting from x (default self.start).
+        """
+        if x is None:
+            x = self.start
+        context = self.get_context(context)
+
+        cg = self.compile()
+        ids = iter(ids)
+        base = len(context)  # the lambdas of this tree push their rules above here
+
+        def choose(nt):
+            i = next(ids)
+            if i < len(cg.idx2rule):
+                return cg.idx2rule[i]
+            else:
+                return context.stack[base + i - len(cg.idx2rule)][0]
+
+        return self.expand(x, choose, context=context)
+
+    def pack(self, t):
+        """
+        Pack a tree into a string of bytes (pack_indices, as varints). Unlike pack_ascii, this works for
+        any number of rules.
+        """
+        return pack_varints(self.pack_indices(t))
+
+    def unpack(self, s, x=None):
+        """ Unpack a string from pack """
+        return self.unpack_indices(unpack_varints(s), x=x)
+
+    def pack_many(self, trees):
+        """ Pack a list of trees into one string of bytes, each preceded by its number of nodes """
+        out = []
+        for t in trees:
+            ids = self.pack_indices(t)
+            out.append(len(ids))
+            out.extend(ids)
+        return pack_varints(out)
+
+    def unpack_many(self, s, x=None):
+        """ Unpack a string from pack_many into a list of trees """
+        ids = unpack_varints(s)
+        trees = []
+        i = 0
+        while i < len(ids):
+            n = ids[i]
+            trees.append(self.unpack_indices(ids[i+1:i+1+n], x=x))
+            i += 1+n
+        return trees
+
+    def pack_ascii(self, t):
+        """
+        Pack a tree into a simple ascii string, using grammar. This is pack_indices with a character for
+        each index, so it only works if there are at most len(pack_string) rules and bound variables.
+        """
+        ids = self.pack_indices(t)
+        assert max(ids) < len(pack_string), "*** Too many rules to pack_ascii; use pack instead"
+        return ''.join([pack_string[i] for i in ids])
 
     def unpack_ascii(self, s):
-        # we must convert to list(s) so that it will support pop, delete
-        s = list(s)
+        """ Unpack a string from pack_ascii """
+        return self.unpack_indices([pack_index[c] for c in s])
 
-        return self.unpack_ascii_rec(s, self.start, self.idx2rule())
+    # --------------------------------------------------------------------------------------------------------
+    # Flat trees
+    # Arrays of rule indices (see FlatTree), for computing over many trees without making FunctionNodes
+    # --------------------------------------------------------------------------------------------------------
+
+    def flatten(self, t):
+        """ Make a FlatTree from t. Its bound variables must be bound by lambdas in t. """
+        cg = self.compile()
+        sig2idx = cg.sig2idx
+        nrules = len(cg.idx2rule)
+        lambdas = []  # the signatures of the bound variables of the lambdas we are below, innermost last
+
+        ids, arity = [], []
+        stack = [t]
+        while stack:
+            x = stack.pop()
+
+            if not isinstance(x, FunctionNode):
+                lambdas.pop()  # x is the added rule of a lambda we are done with
+                continue
+
+            sig = x.get_rule_signature()
+            i = sig2idx.get(sig)
+            if i is None:
+                k = [k for k, s in enumerate(reversed(lambdas)) if s == sig]
+                assert len(k) > 0, "*** %s is not a rule, or a bound variable of a lambda in the tree" % str(sig)
+                i = nrules + k[0]
+            ids.append(i)
+
+            kids = x.argFunctionNodes()
+            arity.append(len(kids))
+
+            if isinstance(x, BVAddFunctionNode):
+                lambdas.append(x.added_rule.get_rule_signature())
+                stack.append(x.added_rule)
+            stack.extend(reversed(kids))
+
+        return FlatTree(ids, arity, nrules)
+
+    def unflatten(self, ft, x=None, context=None):
+        """ Make a FunctionNode from FlatTree ft, starting from x (default: the nonterminal of ft's first rule) """
+        cg = self.compile()
+        nrules = len(cg.idx2rule)
+        assert ft.nrules == nrules, "*** This FlatTree was made with a different grammar"
+        context = self.get_context(context)
+        if x is None:
+            x = cg.idx2rule[ft.ids[0]].nt
+
+        ids = iter(ft.ids.tolist())
+        base = len(context)  # the lambdas of this tree push their rules above here
+
+        def choose(nt):
+            i = next(ids)
+            if i < nrules:
+                return cg.idx2rule[i]
+            else:
+                j = len(context) - 1 - (i - nrules)
+                assert j >= base, "*** Bound variable %s is not bound in this tree" % i
+                return context.stack[j][0]
 
-    def unpack_ascii_rec(self, s, x, idx2rule):
+        return self.expand(x, choose, context=context)
+
+    def flat_log_probability(self, ft, context=None):
         """
-        Unpack a string into a tree. Follows the format of Grammar.generate, but indexes
-        the choices with s
+        log_probability for a FlatTree. If ft has no lambdas (and context has no bound variables), this is just a
+        sum over cg.idx_log_p; otherwise we go through ft once to find the normalizers with the bound variables
+        in scope, and sum those with numpy.
         """
-        assert x is not None  # should have been given by unpack_ascii
+        cg = self.compile()
+        nrules = len(cg.idx2rule)
+        assert ft.nrules == nrules, "*** This FlatTree was made with a different grammar"
+        context = self.get_context(context)
+
+        bound = ft.is_bound()
+        unbound_ids = ft.ids[~bound]
+        if not bound.any() and not cg.idx_is_lambda[unbound_ids].any() and len(context.p) == 0:
+            return cg.idx_log_p[unbound_ids].sum()
+
+        extra = dict(context.p)  # nonterminal -> total p of its bound variables in scope
+        lambdas = []             # (nonterminal, p) of each bound variable in scope, innermost last
+        frames = []              # [children left to start, whether a lambda] for each node not yet finished
+        normalizers = []
+        lp = cg.idx_log_weight[unbound_ids].sum()
+        for i, a in zip(ft.ids.tolist(), ft.arity.tolist()):
+            if i < nrules:
+                r = cg.idx2rule[i]
+                nt = r.nt
+            else:
+                nt, p = lambdas[-1 - (i - nrules)]
+                lp += log(p)
+            normalizers.append(cg.z.get(nt, 0.0) + extra.get(nt, 0.0))
 
-        # Dispatch different kinds of generation
-        if isinstance(x, list):
-            return map(lambda xi: self.unpack_ascii_rec(s, xi, idx2rule), x)
+            if frames:
+                frames[-1][0] -= 1
 
-        elif self.is_nonterminal(x):
-            
-            rules = self.get_rules(x)
-
-            # index
-            # instead of sampling a rule, get it from the string
-            i = pack_string.index(s[0])
-            del s[0]  # remove (works since s is a list)
-            r = idx2rule[i]
-
-            # Make a stub for this functionNode
-            fn = r.make_FunctionNodeStub(self, None)
-            with BVRuleContextManager(self, fn, recurse_up=False):
-
-                # add rule (to idx2rule)
-                if isinstance(r, BVAddGrammarRule):
-                    idx = max(idx2rule.keys()) + 1
-                    idx2rule[idx] = fn.added_rule
-
-                # recurse
-                if fn.args is not None:
-                    fn.args = self.unpack_ascii_rec(s, fn.args, idx2rule)
-
-                # remove rule (as we now do in packing, too)
-                if isinstance(r, BVAddGrammarRule):
-                    idx = max(idx2rule.keys())
-                    del idx2rule[idx]
-            
-                for a in fn.argFunctionNodes():
-                    a.parent = fn
+            is_lambda = i < nrules and isinstance(r, BVAddGrammarRule)
+            if is_lambda:
+                p = self.BV_P if r.bv_p is None else r.bv_p
+                lambdas.append((r.bv_type, p))
+                extra[r.bv_type] = extra.get(r.bv_type, 0.0) + p
+            frames.append([a, is_lambda])
 
-            return fn
+            # finish the nodes whose last subtree this ends
+            while frames and frames[-1][0] == 0:
+                if frames.pop()[1]:
+                    nt, p = lambdas.pop()
+                    extra[nt] -= p
 
-        else: # must be a terminal
-            return x
+        return lp - np.log(normalizers).sum()
+
+    def flat_rule_counts(self, ft):
+        """
+        A list of vectors of how often each nonterminal is expanded each way in FlatTree ft, indexed by the
+        compiled grammar's rule ids (as in RationalRules.get_rule_counts). Bound variables are not counted.
+        """
+        cg = self.compile()
+        counts = ft.rule_counts()
+        return [counts[cg.offsets[nt]:cg.offsets[nt]+cg.nrules(nt)] for nt in cg.nonterminals]
 
     #def pack_test(self,n=1000):
     #    """a quick test for packing and unpacking"""
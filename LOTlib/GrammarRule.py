@@ -1,4 +1,4 @@
-from FunctionNode import FunctionNode, BVAddFunctionNode, BVUseFunctionNode
+from FunctionNode import FunctionNode, BVAddFunctionNode, BVUseFunctionNode, bv_level_name
 from copy import copy
 from LOTlib.Miscellaneous import None2Empty,self_update
 from uuid import uuid4
@@ -36,6 +36,8 @@ class GrammarRule(object):
     The rule id (rid) is very important -- it's what we use expansion determine equality
 
     """
+    changes = 0 # incremented whenever any rule's p is set, so that grammars know their caches are stale
+
     def __init__(self, nt, name, to, p=1.0, bv_prefix=None):
         p = float(p)
         assert p>0.0, "*** p=0 in rule %s %s %s. What are you thinking?" %(nt,name,to)
@@ -50,6 +52,15 @@ class GrammarRule(object):
             assert (to is None) or (len(to) == 1), \
                 "*** GrammarRules with empty names must have only 1 argument"
 
+    @property
+    def p(self):
+        return self.__dict__['p'] # set by self_update in __init__, without counting as a change
+
+    @p.setter
+    def p(self, p):
+        self.__dict__['p'] = p
+        GrammarRule.changes += 1
+
     def __repr__(self):
         """Print string in format: 'NT -> [TO]   w/ p=1.0'."""
         return str(self.nt) + " -> " + self.name + (str(self.to) if self.to is not None else '') + \
@@ -73,8 +84,9 @@ class GrammarRule(object):
             sig.extend(self.to)
         return tuple(sig)
 
-    def make_FunctionNodeStub(self, grammar, parent):
+    def make_FunctionNodeStub(self, grammar, parent, context=None):
         # NOTE: It is VERY important to copy to, or else we end up with big problems!
+        # context (the bound variables in scope) is only needed by BVAddGrammarRule
         fn = FunctionNode(parent, returntype=self.nt, name=self.name, args=copy(self.to))
         assert fn.get_rule_signature() == self.get_rule_signature() # potentially not needed
         return fn
@@ -117,9 +129,13 @@ class BVAddGrammarRule(GrammarRule):
             "\tw/ p=" + str(self.p) + "," + \
             "\tBV:" + str(self.bv_type) + ";" + str(self.bv_args) + ";" + self.bv_prefix
     
-    def make_bv_rule(self, grammar):
+    def make_bv_rule(self, grammar, level=None):
         """Construct the rule that we introduce at a given depth.
 
+        Arguments:
+            level (int): how many lambdas are above us. In a de Bruijn grammar (see Grammar), the bound variable
+                is named by this instead of a uuid, so it must be given.
+
         Note:
             * This is a GrammarRule and NOT a BVGrammarRule because the introduced rules should *not*
                 themselves introduce rules!
@@ -129,9 +145,13 @@ class BVAddGrammarRule(GrammarRule):
         bvp = self.bv_p
         if bvp is None:
             bvp = grammar.BV_P
-        return BVUseGrammarRule(self.bv_type, self.bv_args, p=bvp, bv_prefix=self.bv_prefix)
+        name = None
+        if grammar.de_bruijn:
+            assert level is not None, "*** De Bruijn grammars must give the level of a bound variable"
+            name = bv_level_name(level)
+        return BVUseGrammarRule(self.bv_type, self.bv_args, p=bvp, bv_prefix=self.bv_prefix, name=name)
 
-    def make_FunctionNodeStub(self, grammar, parent):
+    def make_FunctionNodeStub(self, grammar, parent, context=None):
         """Return a FunctionNode with none of the arguments realized. That's a "stub"
 
         Arguments
@@ -139,6 +159,9 @@ class BVAddGrammarRule(GrammarRule):
         d : int
             the current depth
         parent : ?
+        context : LOTlib.BVContext
+            the bound variables in scope, which (in a de Bruijn grammar) give our level. If None, we count the
+            lambdas above parent.
 
         Note
         ----
@@ -147,7 +170,15 @@ class BVAddGrammarRule(GrammarRule):
         * It is VERY important to copy to, or else we end up with garbage
 
         """
-        fn = BVAddFunctionNode(parent, returntype=self.nt, name=self.name, args=copy(self.to), added_rule=self.make_bv_rule(grammar))
+        level = None
+        if grammar.de_bruijn:
+            if context is not None:
+                level = len(context)
+            else:
+                level = 0 if parent is None else len([a for a in parent.up_to() if isinstance(a, BVAddFunctionNode)])
+
+        fn = BVAddFunctionNode(parent, returntype=self.nt, name=self.name, args=copy(self.to),
+                               added_rule=self.make_bv_rule(grammar, level))
         assert fn.get_rule_signature() == self.get_rule_signature() # potentially not needed
         return fn
 
@@ -157,13 +188,13 @@ class BVUseGrammarRule(GrammarRule):
     A Grammar rule that is the use of a bound variable. (e.g. in (lambda (y) ...), this rule is active in the ...
     and allows you to make y).
 
-    Each of these has a unique name via uuid.
+    Each of these has a unique name via uuid, unless it is given one (see bv_level_name).
 
     """
-    def __init__(self, nt, to, p=1.0, bv_prefix=None):
-        GrammarRule.__init__(self, nt, 'bv__'+uuid4().hex, to, p, bv_prefix)
+    def __init__(self, nt, to, p=1.0, bv_prefix=None, name=None):
+        GrammarRule.__init__(self, nt, 'bv__'+uuid4().hex if name is None else name, to, p, bv_prefix)
 
-    def make_FunctionNodeStub(self, grammar, parent):
+    def make_FunctionNodeStub(self, grammar, parent, context=None):
         fn = BVUseFunctionNode(parent, returntype=self.nt, name=self.name, args=copy(self.to))
         assert fn.get_rule_signature() == self.get_rule_signature() # potentially not needed
         return fn
@@ -1,8 +1,8 @@
-from LOTlib.Eval import * # Necessary for compile_function eval below
+from LOTlib.Eval import *
 from LOTlib.Hypotheses.FunctionHypothesis import FunctionHypothesis
 from LOTlib.Hypotheses.Proposers import regeneration_proposal, ProposalFailedException
-from LOTlib.Miscellaneous import self_update
-from LOTlib.Primitives import *
+from LOTlib.Miscellaneous import self_update, raise_exception
+from LOTlib.Primitives import get_namespace
 from Priors.PCFGPrior import PCFGPrior
 
 class LOTHypothesis(PCFGPrior, FunctionHypothesis):
@@ -24,8 +24,15 @@ class LOTHypothesis(PCFGPrior, FunctionHypothesis):
     grammar_vector : np.ndarray
         This is a vector of
     prior_vector : np.ndarray
+    step_budget : int
+        The most primitive calls one call of the function may make before it raises a TooBigException (None for
+        no limit). Set this (or time_budget) on a subclass to cut off runaway hypotheses.
+    time_budget : float
+        The most seconds one call of the function may take (None for no limit)
 
     """
+    step_budget = None
+    time_budget = None
 
     def __init__(self, grammar=None, value=None, f=None, maxnodes=25, **kwargs):
 
@@ -57,12 +64,19 @@ class LOTHypothesis(PCFGPrior, FunctionHypothesis):
         return self.value.type()
 
     def compile_function(self):
-        """Called in set_value to compile into a function."""
+        """Called in set_value to compile into a function, in the namespace of primitives. Functions are shared
+        through LOTlib.Eval.function_cache, so the same program is only compiled once. The function keeps to
+        step_budget and time_budget, and when primitives are being timed, it also counts its primitive calls in
+        self.primitive_ops."""
         if self.value.count_nodes() > self.maxnodes:
             return lambda *args: raise_exception(TooBigException)
         else:
             try:
-                return eval(str(self)) # evaluate_expression(str(self))
+                s = str(self)
+                f = function_cache.get(s, lambda: eval(s, get_namespace())) # evaluate_expression(str(self))
+                if self.step_budget is not None or self.time_budget is not None:
+                    f = instrumentation.budget(f, self.step_budget, self.time_budget)
+                return instrumentation.count(self, f) if instrumentation.timing else f
             except Exception as e:
                 print "# Warning: failed to execute evaluate_expression on " + str(self)
                 print "# ", e
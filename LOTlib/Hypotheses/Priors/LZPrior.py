@@ -1,5 +1,4 @@
 from LOTlib.Miscellaneous import attrmem,Infinity
-from LOTlib.Grammar import pack_string
 from LZutil.IntegerCodes import to_fibonacci as integer2bits # Use Mackay's Fibonacci code
 from LZutil.LZ2 import encode
 
@@ -15,9 +14,8 @@ class LZPrior(object):
 
             return -Infinity
 
-        s = self.grammar.pack_ascii(self.value)
         # 1+ since it must be positive
-        bits = ''.join([ integer2bits(1+pack_string.index(x)) for x in s ])
+        bits = ''.join([ integer2bits(1+i) for i in self.grammar.pack_indices(self.value) ])
         c = encode(bits, pretty=0)
 
         return -len(c)
@@ -3,31 +3,20 @@ import numpy
 
 from LOTlib.Hypotheses.LOTHypothesis import LOTHypothesis
 from LOTlib.Miscellaneous import Infinity, beta, attrmem
-from LOTlib.FunctionNode import FunctionNode
-from collections import defaultdict
+from LOTlib.FlatTree import FlatTree
 
 def get_rule_counts(grammar, t):
     """
-            A list of vectors of counts of how often each nonterminal is expanded each way
-
-            TODO: This is probably not super fast since we use a hash over rule ids, but
-                    it is simple!
+            A list of vectors of counts of how often each nonterminal is expanded each way,
+            indexed by the compiled grammar's rule ids. t may be a FunctionNode or a FlatTree.
     """
+    if not isinstance(t, FlatTree):
+        t = grammar.flatten(t)
 
-    counts = defaultdict(int) # a count for each hash type
-
-    for x in t:
-        if type(x) != FunctionNode:
-            raise NotImplementedError("Rational rules not implemented for bound variables")
-        
-        counts[x.get_rule_signature()] += 1
+    if t.is_bound().any() or grammar.compile().idx_is_lambda[t.ids].any():
+        raise NotImplementedError("Rational rules not implemented for bound variables")
 
-    # and convert into a list of vectors (with the right zero counts)
-    out = []
-    for nt in grammar.rules.keys():
-        v = numpy.array([ counts.get(r.get_rule_signature(),0) for r in grammar.rules[nt] ])
-        out.append(v)
-    return out
+    return grammar.flat_rule_counts(t)
 
 def RR_prior(grammar, t, alpha=1.0):
     """
@@ -7,11 +7,11 @@ it.
 
 from LOTlib.Hypotheses.Proposers.RegenerationProposal import regeneration_proposal
 from LOTlib.Hypotheses.Proposers import ProposalFailedException
-from LOTlib.BVRuleContextManager import BVRuleContextManager
+from LOTlib.BVContext import BVContext
 from LOTlib.FunctionNode import NodeSamplingException
 from LOTlib.Miscellaneous import lambdaOne
 from copy import copy, deepcopy
-from random import random
+from random import random, randint
 from math import log
 
 class CopyRegenProposal(object):
@@ -28,36 +28,47 @@ class CopyRegenProposal(object):
 
         return ret, fb
 
-def give_grammar(grammar,node):
+def give_context(grammar,node):
     # Remember: BVRuleContextManager looks at the rule context for
     # generation inside this node, not at the node itself, so we want
     # to consider the node's parent
-    with BVRuleContextManager(grammar, node.parent, recurse_up=True):
-        g = deepcopy(grammar)
-    return g
+    context = BVContext()
+    context.push_node(node.parent, recurse_up=True)
+    return context
 
-def copy_regen_proposal(grammar, t, resampleProbability=lambdaOne):
-    """Propose, returning the new tree and MH acceptance probability"""
+def copy_regen_proposal(grammar, t, resampleProbability=lambdaOne, persistent=False):
+    """Propose, returning the new tree and MH acceptance probability
+
+    If persistent, t is not copied, and the new tree shares everything but the path down to the change with t
+    (see FunctionNode.replace_at_path).
+    """
 
     if random() < 0.5: # copy!
-        newt = copy(t)
+        newt = t if persistent else copy(t)
 
         # sample the source and then the target conditioned on having the same grammar as the source
         # Note: the two nodes need not be different
         try:
             src, lp_choosing_src_in_old_tree = newt.sample_subnode(resampleProbability)
-            src_grammar = give_grammar(grammar,src)
-            good_choice = lambda x: 1.0 if ((give_grammar(grammar,x) == src_grammar) and
-                                            (x.returntype == src.returntype)) else 0.0
-            target, lp_choosing_target_in_old_tree = newt.sample_subnode(good_choice)
+            src_context = give_context(grammar,src)
+            # the target is uniform over the nodes of src's type in the same context (which includes src)
+            good_paths = [p for p in newt.returntype_paths(src.returntype)
+                          if give_context(grammar, p[-1]).rules == src_context.rules]
+            path = good_paths[randint(0, len(good_paths)-1)]
+            lp_choosing_target_in_old_tree = -log(len(good_paths))
+            target = path[-1]
         except NodeSamplingException:
             raise ProposalFailedException
 
-        # context manager not needed here since we already have the correct grammar
-        lp_target_given_grammar = src_grammar.log_probability(target)
+        # context manager not needed here since we already have the correct context
+        lp_target_given_grammar = grammar.log_probability(target, context=src_context)
 
         # set target to be src via a deep copy
-        target.setto(deepcopy(src))
+        if persistent:
+            target = copy(src) # copy, not deepcopy, which would also copy everything above src via its parent
+            newt = t.replace_at_path(path, target)
+        else:
+            target.setto(deepcopy(src))
 
         # forward: sample source from old tree, sample target from old tree, copy deterministically
         f = lp_choosing_src_in_old_tree + lp_choosing_target_in_old_tree
@@ -72,7 +83,7 @@ def copy_regen_proposal(grammar, t, resampleProbability=lambdaOne):
 
     else: # regenerate
 
-        return regeneration_proposal(grammar, t, resampleProbability=resampleProbability)
+        return regeneration_proposal(grammar, t, resampleProbability=resampleProbability, persistent=persistent)
 
 if __name__ == "__main__": # test code
 
@@ -6,6 +6,7 @@ its children (of the same type)
 """
 
 from LOTlib.BVRuleContextManager import BVRuleContextManager
+from LOTlib.BVContext import BVContext
 from LOTlib.FunctionNode import *
 from LOTlib.GrammarRule import *
 from LOTlib.Hypotheses.Proposers import ProposalFailedException
@@ -29,27 +30,35 @@ class InsertDeleteProposal(object):
 def can_insert_GrammarRule(r):
     return any([r.nt==a for a in None2Empty(r.to)])
 
+@local_weight
 def can_insert_FunctionNode(x):
     return any([x.returntype == a.returntype for a in x.argFunctionNodes()])
 
 def can_delete_GrammarRule(r):
     return any([r.nt==a for a in None2Empty(r.to)])
 
+@local_weight
 def can_delete_FunctionNode(x):
     if isinstance(x, BVAddFunctionNode) and x.uses_bv():
         return False
     else:
         return any([x.returntype == a.returntype for a in x.argFunctionNodes()])
 
-def insert_delete_proposal(grammar, t):
-    newt = copy(t)
+def insert_delete_proposal(grammar, t, persistent=False):
+    """Propose, returning the new tree and MH acceptance probability.
+
+    If persistent, t is not copied, and the new tree shares everything but the path down to the change with t
+    (see FunctionNode.replace_at_path).
+    """
+    newt = t if persistent else copy(t)
 
     if random() < 0.5: # insert!
 
         # Choose a node at random to insert on
         # TODO: We could precompute the nonterminals we can do this move on, if we wanted
         try:
-            ni, lp = newt.sample_subnode(can_insert_FunctionNode)
+            path, lp = newt.sample_subnode_path(can_insert_FunctionNode)
+            ni = path[-1]
         except NodeSamplingException:
             raise ProposalFailedException
 
@@ -71,27 +80,38 @@ def insert_delete_proposal(grammar, t):
         
         replace_i = sample1(replicatingindices) # choose the one to replace
         
-        ## Now expand the other args, with the right rules in the grammar
-        with BVRuleContextManager(grammar, fn, recurse_up=True):
+        ## Now expand the other args, with the right rules in our context
+        context = BVContext()
+        with BVRuleContextManager(grammar, fn, recurse_up=True, context=context):
 
             for i,a in enumerate(fn.args):
                 if i == replace_i:
                     fn.args[i] = copy(ni) # the one we replace
                 else:
-                    fn.args[i] = grammar.generate(a) #else generate like normal
+                    fn.args[i] = grammar.generate(a, context=context) #else generate like normal
 
         # we need a count of how many kids are the same afterwards
         after_same_children = sum([x==ni for x in fn.args])
                     
+        for a in fn.argFunctionNodes():
+            a.parent = fn
+
+        # in a de Bruijn grammar, inserting a lambda changes the names of the ones below it
+        if grammar.de_bruijn and isinstance(fn, BVAddFunctionNode):
+            fn.args[replace_i].renumber_bv()
+
         # perform the insertion
-        ni.setto(fn)
+        if persistent:
+            newt = t.replace_at_path(path, fn)
+        else:
+            ni.setto(fn)
 
         # TODO: fix the fact that there are potentially multiple backward steps to give the equivalent tree
-        # need to use the right grammar for log_probability calculations
-        with BVRuleContextManager(grammar, fn, recurse_up=True):
+        # need to use the right context for log_probability calculations
+        with BVRuleContextManager(grammar, fn, recurse_up=True, context=context):
 
             # what is the prob mass of the new stuff?
-            new_lp_below =  sum([ grammar.log_probability(fn.args[i]) if (i!=replace_i and isFunctionNode(fn.args[i])) else 0. for i in xrange(len(fn.args))])
+            new_lp_below =  sum([ grammar.log_probability(fn.args[i], context=context) if (i!=replace_i and isFunctionNode(fn.args[i])) else 0. for i in xrange(len(fn.args))])
 
             # What is the new normalizer?
             newZ = newt.sample_node_normalizer(can_delete_FunctionNode)
@@ -105,7 +125,8 @@ def insert_delete_proposal(grammar, t):
     else: # delete!
 
         try: # sample a node at random
-            ni, lp = newt.sample_subnode(can_delete_FunctionNode) # this could raise exception
+            path, lp = newt.sample_subnode_path(can_delete_FunctionNode) # this could raise exception
+            ni = path[-1]
 
             if ni.args is None: # doesn't have children to promote
                 raise NodeSamplingException
@@ -124,18 +145,24 @@ def insert_delete_proposal(grammar, t):
 
         samplei = sample1(replicating_kid_indices) # who to promote; NOTE: not done via any weighting
 
-        # We need to be in the right grammar state to evaluate log_probability
-        with BVRuleContextManager(grammar, ni.args[samplei], recurse_up=True):
+        # We need to be in the right context to evaluate log_probability
+        context = BVContext()
+        with BVRuleContextManager(grammar, ni.args[samplei], recurse_up=True, context=context):
 
             # Now we must count the multiple ways we could go forward or back
             # Here, we could have sampled any of them equivalent to ni.args[i]
             before_same_children = sum([x==ni.args[samplei] for x in ni.args ]) # how many are the same after?
 
             # the lp of everything we'd have to create going backwards
-            old_lp_below = sum([ grammar.log_probability(ni.args[i]) if (i!=samplei and isFunctionNode(ni.args[i])) else 0. for i in xrange(len(ni.args))])
+            old_lp_below = sum([ grammar.log_probability(ni.args[i], context=context) if (i!=samplei and isFunctionNode(ni.args[i])) else 0. for i in xrange(len(ni.args))])
 
-            # and replace it
-            ni.setto( ni.args[samplei] )
+            # and replace it (copying the promoted child in persistent mode, since its parent changes)
+            deleted_lambda = isinstance(ni, BVAddFunctionNode)
+            if persistent:
+                ni = copy(ni.args[samplei])
+                newt = t.replace_at_path(path, ni)
+            else:
+                ni.setto( ni.args[samplei] )
 
             newZ = newt.sample_node_normalizer(resampleProbability=can_insert_FunctionNode)
             
@@ -144,6 +171,11 @@ def insert_delete_proposal(grammar, t):
             # backward: choose the node, choose the replicating rule, choose where to put it, and generate the rest of the tree
             b = (nicelog(1.0*can_insert_FunctionNode(ni)) - nicelog(newZ)) - nicelog(len(replicating_rules)) + (nicelog(before_same_children) - nicelog(nrk)) + old_lp_below
 
+        # in a de Bruijn grammar, deleting a lambda changes the names of the ones below it (which we can only do
+        # now that the rules in context have been popped)
+        if grammar.de_bruijn and deleted_lambda:
+            ni.renumber_bv()
+
     return [newt, f-b]
 
 if __name__ == "__main__": # test code
@@ -5,9 +5,10 @@ with a newly sampled value of type X.
 """
 
 from LOTlib.BVRuleContextManager import BVRuleContextManager
+from LOTlib.BVContext import BVContext
 from LOTlib.FunctionNode import FunctionNode, NodeSamplingException
 from LOTlib.Hypotheses.Proposers import ProposalFailedException
-from LOTlib.Miscellaneous import lambdaOne
+from LOTlib.Miscellaneous import lambdaOne, Infinity
 from copy import copy
 from math import log
 
@@ -25,28 +26,62 @@ class RegenerationProposal(object):
 
         return ret, fb
 
-def regeneration_proposal(grammar, t, resampleProbability=lambdaOne):
-    """Propose, returning the new tree and the prob. of sampling it."""
+def regeneration_proposal(grammar, t, resampleProbability=lambdaOne, maxnodes=None, persistent=False):
+    """Propose, returning the new tree and the prob. of sampling it.
 
-    newt = copy(t)
+    If maxnodes is given, the new subtree is generated conditioned on the whole tree having at most maxnodes
+    nodes (see Grammar.generate_within), and the forward and backward probabilities include that
+    normalizer. If t is itself too big, we regenerate as though maxnodes were not given; but if the new tree is
+    not too big, the move back (within maxnodes) could never give t, so the backward probability is 0.
+
+    If persistent, t is not copied: the new tree shares everything but the path down to the new subtree with t
+    (see FunctionNode.replace_at_path), so neither may be changed in place afterwards.
+    """
 
     try:
         # sample a subnode
-        n, lp = newt.sample_subnode(resampleProbability=resampleProbability)
+        if persistent:
+            path, lp = t.sample_subnode_path(resampleProbability=resampleProbability)
+            newt, n = t, path[-1]
+        else:
+            newt = copy(t)
+            n, lp = newt.sample_subnode(resampleProbability=resampleProbability)
     except NodeSamplingException:
         # If we've been given resampleProbability that can't sample
         raise ProposalFailedException
 
     assert getattr(n, "resampleProbability", 1.0) > 0.0, "*** Error in propose_tree %s ; %s" % (resampleProbability(t), t)
 
+    # how many nodes can the new subtree have? (the rest of the tree is the same going forward and back)
+    budget = None
+    if maxnodes is not None and newt.count_nodes() <= maxnodes:
+        budget = maxnodes - (newt.count_nodes() - n.count_nodes())
+
     # In the context of the parent, resample n according to the grammar
-    # We recurse_up in order to add all the parent's rules
-    with BVRuleContextManager(grammar, n.parent, recurse_up=True):
-        n.setto(grammar.generate(n.returntype))
+    # We recurse_up in order to add all the parent's rules. These go on our own context, not the grammar's.
+    context = BVContext()
+    with BVRuleContextManager(grammar, n.parent, recurse_up=True, context=context):
+        if budget is None:
+            new = grammar.generate(n.returntype, context=context)
+            lZ = 0.0
+        else:
+            new = grammar.generate_within(n.returntype, maxnodes=budget, context=context)
+            # the probability of generating at most budget nodes (in the same context both ways)
+            lZ = log(grammar.size_mass(n.returntype, budget, context=context))
+
+    if persistent:
+        newt = t.replace_at_path(path, new)
+        n = new
+    else:
+        n.setto(new)
 
     # compute the forward/backward probability (i.e. the acceptance distribution)
-    f = lp + grammar.log_probability(newt) # p_of_choosing_node_in_old_tree * p_of_new_tree
-    b = (log(1.0*resampleProbability(n)) - log(newt.sample_node_normalizer(resampleProbability=resampleProbability)))\
-        + grammar.log_probability(t) # p_of_choosing_node_in_new_tree * p_of_old_tree
+    f = lp + grammar.log_probability(newt) - lZ # p_of_choosing_node_in_old_tree * p_of_new_tree
+    if budget is None and maxnodes is not None and newt.count_nodes() <= maxnodes:
+        b = -Infinity # t was too big to regenerate from newt
+    else:
+        b = (log(1.0*resampleProbability(n)) -
+             log(newt.sample_node_normalizer(resampleProbability=resampleProbability))) \
+            + grammar.log_probability(t) - lZ # p_of_choosing_node_in_new_tree * p_of_old_tree
 
     return [newt, f-b]
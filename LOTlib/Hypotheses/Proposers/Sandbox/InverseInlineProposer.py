@@ -176,7 +176,7 @@ class InverseInlineProposer(object):
             possible_rules = [r for r in self.grammar.rules[n.returntype] if r.name==n.name and tuple(r.to) == tuple(n.argTypes()) ]
             assert len(possible_rules) == 1 # for now?
 
-            n.rule = possible_rules[0]
+            n.set_extra('rule', possible_rules[0])
 
             ir = self.insertable_rules[n.returntype] # for the backward probability
             f = np # just the probability of choosing this apply
@@ -4,15 +4,17 @@ from LOTlib.Hypotheses.Proposers import ProposalFailedException
 from LOTlib.Hypotheses.Proposers.RegenerationProposal import RegenerationProposal
 from LOTlib.Miscellaneous import lambdaOne, Infinity, weighted_sample
 from LOTlib.Hypotheses.Hypothesis import Hypothesis
-from LOTlib.FunctionNode import NodeSamplingException
+from LOTlib.FunctionNode import NodeSamplingException, returntype_weight
 from copy import copy
 
 def crossover_lot(x,y):
     t = copy(x.value)
     n1, _ = t.sample_subnode(resampleProbability=lambdaOne)
-    n2, _ = y.value.sample_subnode(resampleProbability=lambda t: 1*(t.returntype==n1.returntype))
+    n2, _ = y.value.sample_subnode(resampleProbability=returntype_weight(n1.returntype))
 
-    n1.setto(n2) # assign the value!
+    n1.setto(copy(n2)) # assign the value! (a copy, so that y's tree is left alone)
+    if x.grammar.de_bruijn:
+        n1.renumber_bv() # n2's lambdas were named by their levels in y's tree
 
     return Hypothesis.__copy__(x, value=t)
 
@@ -45,6 +45,12 @@ def create_counts(grammar, hypotheses, which_rules=None, log=None):
     # First set up the mapping between signatures and indexes
     sig2idx = dict() # map each signature to a unique index in its nonterminal
     next_free_idx = Counter()
+    if which_rules is grammar_rules:
+        # all of the rules, so these are just the compiled grammar's ids
+        cg = grammar.compile()
+        sig2idx.update(cg.signature2id)
+        for nt in cg.nonterminals:
+            next_free_idx[nt] = cg.nrules(nt)
     for r in which_rules:
         nt, s = r.nt, r.get_rule_signature()
 
@@ -60,19 +66,31 @@ def create_counts(grammar, hypotheses, which_rules=None, log=None):
 
     for i, h in enumerate(hypotheses):
 
-        # Build up a lost of all the nodes, depending on what type of hypotheses we got
+        # Build up a lost of all the trees, depending on what type of hypotheses we got
         if isinstance(h, FunctionNode):
-            nodes = [n for n in h]
+            trees = [h]
         if isinstance(h, LOTHypothesis):
-            nodes = [n for n in h.value]
+            trees = [h.value]
         elif isinstance(h, SimpleLexicon):
-            nodes = []
+            trees = []
             for w in h.value.keys():
                 assert isinstance(h.value[w], LOTHypothesis), "*** Not implemented unless Lexicon values are LOTHypotheses"
-                nodes.extend([n for n in h.value[w].value])
+                trees.append(h.value[w].value)
+
+        if which_rules is grammar_rules:
+            # every rule is counted, so count with the trees' rule indices (see Grammar.flatten)
+            for t in trees:
+                for nt, c in zip(cg.nonterminals, grammar.flat_rule_counts(grammar.flatten(t))):
+                    counts[nt][i, :len(c)] += c
+
+                # bound variables are never counted
+                for n in t:
+                    if isinstance(n, BVUseFunctionNode):
+                        prior_offset[i] += grammar.single_probability(n)
+            continue
 
         # Iterate through the nodes and count rule usage
-        for n in nodes:
+        for n in [n for t in trees for n in t]:
             if n.get_rule_signature() in which_signatures:
                 if not isinstance(n, BVUseFunctionNode): ## NOTE: Not currently doing bound variables
                     nt, s = n.returntype, n.get_rule_signature()
@@ -10,8 +10,8 @@ from collections import defaultdict
 
 from LOTlib.Miscellaneous import Infinity, lambdaAssertFalse, logsumexp
 from LOTlib.BVRuleContextManager import BVRuleContextManager
+from LOTlib.BVContext import BVContext
 from LOTlib.FunctionNode import FunctionNode
-from LOTlib.GrammarRule import GrammarRule
 
 from State import State, StatePruneException
 from MaxScoreState import MaxScoreState
@@ -47,8 +47,7 @@ class LOTHypothesisState(MaxScoreState):
 
         #We must modify the grammar to include one more nonterminal here
         mynt = "<hsmake>"
-        myr = GrammarRule(mynt, '', [grammar.start], p=1.0)
-        grammar.rules[mynt].append(myr)
+        myr = grammar.add_rule(mynt, '', [grammar.start], 1.0)
         return cls(make_h0(value=FunctionNode(None, mynt,  '', [grammar.start], rule=myr)), data, grammar, hole_penalty=hole_penalty, parent=None, **args) # the top state
 
     def __init__(self, value, data, grammar, hole_penalty=None, **kwargs):
@@ -137,9 +136,10 @@ class LOTHypothesisState(MaxScoreState):
 
         # Now make the children below
         children = []
-        with BVRuleContextManager(self.grammar, fn, recurse_up=True):
-            rules = self.grammar.get_rules(fn.args[argi])
-            lZ = log(sum([r.p for r in rules]))
+        context = BVContext()
+        with BVRuleContextManager(self.grammar, fn, recurse_up=True, context=context):
+            rules = self.grammar.get_rules(fn.args[argi], context)
+            lZ = self.grammar.log_normalizer(fn.args[argi], context)
 
             for r in rules:
                 fn.args[argi] = r.make_FunctionNodeStub(self.grammar, fn)
@@ -64,6 +64,9 @@ class MHSampler(Sampler):
         Was the last proposal accepted?
     samples_yielded : int
         How many samples have I yielded? This doesn't count skipped samples.
+    budget_exceeded : int
+        How many times did evaluating a hypothesis go over its budget (see LOTHypothesis.step_budget)? This
+        includes scoring current_sample in __init__, which posterior_calls does not count.
 
 
     """
@@ -77,8 +80,8 @@ class MHSampler(Sampler):
             self.proposer = lambda x: x.propose()
 
         self.samples_yielded = 0
-        self.set_state(current_sample, compute_posterior=(current_sample is not None))
         self.reset_counters()
+        self.set_state(current_sample, compute_posterior=(current_sample is not None))
 
     def at_temperature(self, t, whichtemperature):
         """Set temperature for prior, likelihood, or acceptance.
@@ -110,6 +113,7 @@ class MHSampler(Sampler):
         self.acceptance_count = 0
         self.proposal_count   = 0
         self.posterior_calls  = 0
+        self.budget_exceeded  = 0
 
     def acceptance_ratio(self):
         """
@@ -18,12 +18,6 @@ from LOTlib.Inference.Proposals.RegenerationProposal import RegenerationProposal
 from MultipleChainMCMC import MultipleChainMCMC
 
 
-class BreakException(Exception):
-    """
-    Break out of multiple loops
-    """
-    pass
-
 # Now we need to define a class to wrap in resample_p so it gets used here.
 class MyProposal(RegenerationProposal):
     def propose_tree(self, t):
@@ -48,21 +42,14 @@ class PartitionMCMC(MultipleChainMCMC):
         """
 
         # first figure out the depth we can go to without exceeding max_N
-        partitions = []
-        try:
-            for d in infrange():
-                #print "# trying ", d
-                tmp = []
-                for i, t in enumerate(grammar.enumerate_at_depth(d, leaves=False)):
-                    tmp.append(t)
-                    if i > max_N:
-                        raise BreakException
-
-                # this gets set if we successfully exit the loop
-                # so it will store the last set that didn't exceed size max_N
-                partitions = tmp
-        except BreakException:
-            pass
+        # We can count the trees without making them, so we only enumerate the depth we use.
+        depth = None
+        for d in infrange():
+            n = grammar.count_at_depth(d, leaves=False)
+            if n > max_N or (n == 0 and depth is not None):
+                break
+            depth = d
+        partitions = list(grammar.enumerate_at_depth(depth, leaves=False))
 
         assert len(partitions) > 0
 
@@ -77,12 +64,13 @@ class PartitionMCMC(MultipleChainMCMC):
 
             for n in p.subnodes():
                 # set to not resample these
-                setattr(n, 'resample_p', 0.0) ## NOTE: This is an old version of how proposals were made, but we use it here to store in each node a prob of being resampled
+                n.set_extra('resample_p', 0.0) ## NOTE: This is an old version of how proposals were made, but we use it here to store in each node a prob of being resampled
 
                 # and fill in the missing leaves with a random generation
                 for i, a in enumerate(n.args):
                     if grammar.is_nonterminal(a):
                         n.args[i] = grammar.generate(a)
+                n.invalidate_caches() # we were printed above
         print "# Initialized %s partitions" % len(partitions)
 
         # initialize each chain
@@ -1,4 +1,5 @@
 from LOTlib.Miscellaneous import Infinity
+from LOTlib.Eval import instrumentation, TooBigException
 
 
 from math import log, exp, isnan
@@ -31,6 +32,10 @@ def MH_acceptance(cur, prop, fb, p=None, acceptance_temperature=1.0):
         # Never accept
         r = float("-inf")
 
+    elif cur == float("-inf"):
+        # Always leave an impossible state, even by a move that cannot be reversed (fb = inf)
+        r = 0.0
+
     else:
         r = (prop-cur-fb) / acceptance_temperature
 
@@ -45,6 +50,8 @@ class Sampler(object):
     'States' for the sampler refer to the most recently yielded sample.
 
     """
+    posterior_calls = 0 # how many times compute_posterior has been called
+    budget_exceeded = 0 # how many times evaluating a hypothesis went over its budget (see compute_posterior)
 
     def __init__(self):
         raise NotImplementedError
@@ -71,7 +78,8 @@ class Sampler(object):
         """
         self.current_sample = s
         if compute_posterior:
-            self.current_sample.compute_posterior(self.data)
+            # not self.compute_posterior, since this is called from __init__, before subclasses have set up
+            self.compute_posterior_within_budget(self.current_sample, self.data)
 
     def str(self):
         return "<%s sampler in state %s>" % (type(self), self.current_sample)
@@ -89,4 +97,20 @@ class Sampler(object):
         A wrapper for hypothesis.compute_posterior(data) that can be overwritten in fancy subclassses.
         """
         self.posterior_calls += 1
-        return h.compute_posterior(data, shortcut=shortcut)
\ No newline at end of file
+        return self.compute_posterior_within_budget(h, data, shortcut=shortcut)
+
+    def compute_posterior_within_budget(self, h, data, shortcut=-Infinity):
+        """
+        h.compute_posterior(data), except that hypotheses that are too big to evaluate (e.g. over their
+        LOTHypothesis.step_budget) get a posterior of -Infinity. budget_exceeded counts how many times a budget
+        was exceeded.
+        """
+        exceeded = instrumentation.exceeded
+        try:
+            return h.compute_posterior(data, shortcut=shortcut)
+        except TooBigException:
+            h.likelihood = -Infinity
+            h.posterior_score = -Infinity
+            return -Infinity
+        finally:
+            self.budget_exceeded += instrumentation.exceeded - exceeded
\ No newline at end of file
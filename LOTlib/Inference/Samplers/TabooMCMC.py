@@ -45,7 +45,7 @@ class TabooMCMC(MHSampler):
         Compute prior & likelihood for `h`, penalizing prior by how many samples have been generated so far.
 
         """
-        return self.seen[h] * self.penalty + h.compute_posterior(data, **kwargs)
+        return self.seen[h] * self.penalty + MHSampler.compute_posterior(self, h, data, **kwargs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+import unittest
+
+from LOTlib.Grammar import Grammar
+from LOTlib.Hypotheses.LOTHypothesis import LOTHypothesis
+from LOTlib.Eval import instrumentation
+from LOTlib.Miscellaneous import Infinity, attrmem
+from Sampler import Sampler
+from MetropolisHastings import MHSampler
+
+
+class SetStateTest(unittest.TestCase):
+    """
+    Set the state of samplers to a hypothesis that goes over its budget
+    """
+    def tearDown(self):
+        instrumentation.counting = False
+        instrumentation.rewrap()
+
+    def runTest(self):
+        print "# Testing setting the state of samplers"
+        grammar = Grammar(start='EXPR')
+        grammar.add_rule('EXPR', 'plus_', ['EXPR', 'EXPR'], 1.0)
+        grammar.add_rule('EXPR', 'x', None, 1.0)
+        t = grammar.generate()
+        while t.count_nodes() < 5:
+            t = grammar.generate()
+
+        class MyH(LOTHypothesis):
+            step_budget = 1
+
+            @attrmem('likelihood')
+            def compute_likelihood(self, data, **kwargs):
+                return sum([self(x) for x in data])
+
+        class MySampler(Sampler): # not an MHSampler, so without reset_counters
+            def __init__(self, h0, data):
+                self.data = data
+                self.set_state(h0)
+
+        for make_sampler in [MySampler, MHSampler]:
+            sampler = make_sampler(MyH(grammar, value=t, maxnodes=Infinity), [1])
+            self.assertEqual(sampler.current_sample.posterior_score, -Infinity)
+            self.assertEqual((sampler.budget_exceeded, sampler.posterior_calls), (1, 0))
@@ -228,6 +228,7 @@ def grammar_gamma(grammar, scale=1.0):
     rules = [r for r in [r for sublist in grammar.rules.values() for r in sublist] if not (r.nt == 'CONST')]
     for r in rules:
         r.p = np.random.gamma(r.p, scale)
+    grammar.invalidate_caches()
     return grammar
 
 
@@ -138,3 +138,4 @@ class GrammarHypothesisOptimized(GrammarHypothesis):
         # Set probability for each rule corresponding to value index
         for i in range(0, self.n):
             self.rules[i].p = self.value[i]
+        self.grammar.invalidate_caches()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+        Compare how many FunctionNodes proposals allocate (and how long they take) when they copy the whole tree
+        and when they are persistent, sharing everything but the changed path with the old tree. Persistent trees
+        keep older ones reachable through their shared nodes' parent refs, so every --compact proposals the chain
+        copies its tree (see FunctionNode.replace_at_path), and those copies count as allocated too.
+"""
+
+from time import time
+from copy import copy
+from optparse import OptionParser
+
+from LOTlib.Examples import load_example
+from LOTlib.Hypotheses.Proposers import regeneration_proposal, insert_delete_proposal, copy_regen_proposal, \
+    ProposalFailedException
+
+parser = OptionParser()
+parser.add_option("--proposals", dest="PROPOSALS", type="int", default=5000, help="Number of proposals to make")
+parser.add_option("--repetitions", dest="REPETITIONS", type="int", default=3, help="Number of repetitions to run")
+parser.add_option("--compact", dest="COMPACT", type="int", default=100, help="Copy persistent trees after this many proposals")
+parser.add_option("--models", dest="MODELS", type="str", default='Magnetism.Simple,Number', help="Which models do we run on?")
+options, _ = parser.parse_args()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def run_chain(grammar, proposal, persistent):
+    """ Make a chain of proposals (accepting all of them), returning the mean number of new nodes per
+    proposal, the mean tree size, and proposals per second (or None if every proposal failed) """
+    t = grammar.generate()
+    allocated, size, n, elapsed = 0, 0, 0, 0.0
+
+    for _ in xrange(options.PROPOSALS):
+        start = time()
+        try:
+            newt, _ = proposal(grammar, t, persistent=persistent)
+        except ProposalFailedException:
+            continue
+        finally:
+            elapsed += time() - start
+
+        # the nodes of newt that are not in t
+        old = set(map(id, t))
+        allocated += sum([id(x) not in old for x in newt])
+        size += newt.count_nodes()
+        n += 1
+        t = newt
+
+        if persistent and n % options.COMPACT == 0:
+            t = copy(t)
+            allocated += t.count_nodes()
+
+    if n == 0:
+        return None
+    return float(allocated) / n, float(size) / n, n / elapsed
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+if __name__ == "__main__":
+
+    print "model\tproposal\titeration\tpersistent\tmean.size\tmean.allocated\tproposals.per.second"
+    for model in options.MODELS.split(','):
+        make_hypothesis, _ = load_example(model)
+        grammar = make_hypothesis().grammar
+
+        for proposal in [regeneration_proposal, insert_delete_proposal, copy_regen_proposal]:
+            for iteration in xrange(options.REPETITIONS):
+                for persistent in [False, True]:
+                    result = run_chain(grammar, proposal, persistent)
+                    if result is None:
+                        continue
+                    allocated, size, speed = result
+
+                    print "\t".join(map(str, [model, proposal.__name__, iteration, persistent,
+                                              round(size, 2), round(allocated, 2), round(speed, 1)]))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+        Compare the speed of generating trees with Grammar.generate against the recursive generator it replaced.
+"""
+
+from time import time
+from optparse import OptionParser
+
+from LOTlib.BVRuleContextManager import BVRuleContextManager
+
+parser = OptionParser()
+parser.add_option("--trees", dest="TREES", type="int", default=10000, help="Number of trees to generate")
+parser.add_option("--repetitions", dest="REPETITIONS", type="int", default=5, help="Number of repetitions to run")
+parser.add_option("--models", dest="MODELS", type="str", default='Number,SymbolicRegression', help="Which models' grammars do we use?")
+options, _ = parser.parse_args()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def recursive_generate(grammar, x):
+    """ The recursive version of Grammar.generate, as a baseline """
+    if isinstance(x, list):
+        return map(lambda xi: recursive_generate(grammar, xi), x)
+    elif grammar.is_nonterminal(x):
+        fn = grammar.sample_rule(x).make_FunctionNodeStub(grammar, None)
+
+        with BVRuleContextManager(grammar, fn, recurse_up=False):
+            if fn.args is not None:
+                fn.args = recursive_generate(grammar, fn.args)
+
+            for a in fn.argFunctionNodes():
+                a.parent = fn
+
+        return fn
+    else:
+        return x
+
+def trees_per_second(f):
+    start = time()
+    for _ in xrange(options.TREES):
+        f()
+    return options.TREES / (time() - start)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+if __name__ == "__main__":
+
+    print "model\titeration\trecursive\titerative"
+    for model in options.MODELS.split(','):
+        exec("from LOTlib.Examples.%s.Model import grammar" % model)
+
+        for iteration in xrange(options.REPETITIONS):
+            recursive = trees_per_second(lambda: recursive_generate(grammar, grammar.start))
+            iterative = trees_per_second(lambda: grammar.generate())
+
+            print "\t".join(map(str, [model, iteration, round(recursive, 1), round(iterative, 1)]))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+        Time importing LOTlib.Hypotheses.LOTHypothesis in a fresh python, and then loading primitive modules with
+        LOTlib.Primitives.load_primitives (none, some, or all of them).
+"""
+
+import sys
+from subprocess import check_output
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("--repetitions", dest="REPETITIONS", type="int", default=10, help="Number of repetitions to run")
+parser.add_option("--loads", dest="LOADS", type="str", default=';Number,Logic,SetTheory;all', help="Which primitive modules do we load after importing? (;-separated sets, 'all' for all of them)")
+options, _ = parser.parse_args()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+TIMER = """
+from time import time
+start = time()
+import LOTlib.Hypotheses.LOTHypothesis
+imported = time()
+from LOTlib.Primitives import load_primitives
+if %r: load_primitives(*%r)
+print imported - start, time() - imported
+"""
+
+def seconds(load):
+    modules = [] if load == 'all' else [m for m in load.split(',') if m]
+    return map(float, check_output([sys.executable, '-c', TIMER % (load != '', modules)]).split())
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+if __name__ == "__main__":
+
+    print "load\titeration\timport\tload.primitives"
+    for load in options.LOADS.split(';'):
+        for iteration in xrange(options.REPETITIONS):
+            imported, loaded = seconds(load)
+            print "\t".join(map(str, [load or 'none', iteration, round(imported, 4), round(loaded, 4)]))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+        Compare the time per node of walking trees with FunctionNode.walk (an explicit stack) against the nested
+        generators it replaced, on unary chains and on full binary trees of increasing depth.
+"""
+
+from time import time
+from optparse import OptionParser
+
+from LOTlib.FunctionNode import FunctionNode
+
+parser = OptionParser()
+parser.add_option("--nodes", dest="NODES", type="int", default=200000, help="About how many nodes to visit per timing")
+parser.add_option("--repetitions", dest="REPETITIONS", type="int", default=3, help="Number of repetitions to run")
+parser.add_option("--depths", dest="DEPTHS", type="str", default='4,8,12,16', help="Which tree depths do we try?")
+options, _ = parser.parse_args()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def recursive_iterdepth(t, d=0):
+    """ The recursive version of FunctionNode.iterdepth, as a baseline """
+    yield (t, d)
+    for a in t.argFunctionNodes():
+        for ssn, dd in recursive_iterdepth(a, d+1):
+            yield (ssn, dd)
+
+def chain(depth):
+    """ f(f(...f(a))) with depth f's """
+    t = FunctionNode(None, 'EXPR', 'a', None)
+    for _ in xrange(depth):
+        t = FunctionNode(None, 'EXPR', 'f', [t])
+        t.args[0].parent = t
+    return t
+
+def bushy(depth):
+    """ A full binary tree of g's, depth deep """
+    if depth == 0:
+        return FunctionNode(None, 'EXPR', 'a', None)
+    t = FunctionNode(None, 'EXPR', 'g', [bushy(depth-1), bushy(depth-1)])
+    for a in t.args:
+        a.parent = t
+    return t
+
+def microseconds_per_node(t, f):
+    n = len(t)
+    repeats = max(1, options.NODES // n)
+    start = time()
+    for _ in xrange(repeats):
+        for _ in f(t):
+            pass
+    return 1e6 * (time() - start) / (repeats * n)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+if __name__ == "__main__":
+
+    print "shape\tdepth\titeration\trecursive\titerative"
+    for shape, make in [('chain', lambda d: chain(2**d)), ('bushy', bushy)]:
+        for depth in map(int, options.DEPTHS.split(',')):
+            t = make(depth)
+
+            for iteration in xrange(options.REPETITIONS):
+                # a chain 2**d long is too deep for the recursive version past python's recursion limit
+                try:
+                    recursive = round(microseconds_per_node(t, recursive_iterdepth), 3)
+                except RuntimeError:
+                    recursive = None
+                iterative = round(microseconds_per_node(t, lambda x: x.walk(yield_depth=True)), 3)
+
+                print "\t".join(map(str, [shape, t.depth(), iteration, recursive, iterative]))
@@ -1,12 +1,47 @@
+"""
+    The modules of primitives. These are not imported until they are needed: the first time a hypothesis is
+    compiled, get_namespace loads all of them into LOTlib.Eval.primitives. They can also be loaded earlier, as in
 
+        load_primitives('Number', 'Logic')
 
-from Arithmetic import *
-from Combinators import *
-from Features import *
-from Functional import *
-from Logic import *
-from Number import *
-from Semantics import *
-from SetTheory import *
-from Stochastics import *
-from Trees import *
+    which does not stop the others from being loaded later. To compile hypotheses with only some of them, ask
+    for that explicitly:
+
+        restrict_primitives('Number', 'Logic')
+"""
+
+from importlib import import_module
+
+from LOTlib.Eval import primitives, register_primitive
+
+MODULES = ['Arithmetic', 'Combinators', 'Features', 'Functional', 'Logic', 'Number', 'Semantics', 'SetTheory',
+           'Stochastics', 'Trees']
+
+loaded = [] # the modules loaded so far
+restricted = False # if True, get_namespace does not load the modules that are not in loaded (see restrict_primitives)
+
+
+def load_primitives(*modules):
+    """ Import these modules (all of them by default) and add their public names to LOTlib.Eval.primitives """
+    for m in (modules or MODULES):
+        assert m in MODULES, "*** Unknown primitive module %s; try one of %s" % (m, MODULES)
+        if m not in loaded:
+            module = import_module('LOTlib.Primitives.'+m)
+            for k, v in vars(module).items():
+                if not k.startswith('_'):
+                    register_primitive(v, name=k)
+            loaded.append(m)
+
+
+def restrict_primitives(*modules):
+    """ Load only these modules: hypotheses are compiled without the others (unless they are loaded by name) """
+    global restricted
+    restricted = True
+    load_primitives(*modules)
+
+
+def get_namespace():
+    """ LOTlib.Eval.primitives, after loading every module unless restrict_primitives was called """
+    if not restricted and len(loaded) < len(MODULES):
+        load_primitives()
+    return primitives
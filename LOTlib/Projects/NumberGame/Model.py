@@ -1,7 +1,8 @@
 
 from math import log
 from LOTlib.Eval import TooBigException
-from LOTlib.Hypotheses.LOTHypothesis import LOTHypothesis, Infinity
+from LOTlib.Hypotheses.LOTHypothesis import LOTHypothesis
+from LOTlib.Miscellaneous import Infinity
 from LOTlib.Miscellaneous import attrmem
 
 ALPHA = 0.95 # Default noise weight
@@ -61,9 +61,11 @@ def next_states(L):
                 if isinstance(old_a, FunctionNode):
                     for new_a in nt_moves[old_a.returntype]:
                         tt.args[i] = new_a
+                        tt.invalidate_caches()
                         yield L.copy() # we go down and copy t and the new node
 
                     tt.args[i] = old_a
+                    tt.invalidate_caches()
 
 def score(L): return sum(L.compute_posterior(data))
 
@@ -113,6 +113,7 @@ def __maximize_entropy(grammar, branching_bound):
 
         for r,x in zip(grammar, x):
             r.p = x
+        grammar.invalidate_caches()
 
         # Add a constraint that the probs sum to one
         zs = [ sum([r.p for r in grammar.get_rules(nt)]) for nt in grammar.nonterminals() ]
@@ -135,6 +136,7 @@ def __maximize_entropy(grammar, branching_bound):
     # Set to the solution
     for r,x in zip(grammar, res.x):
             r.p = x
+    grammar.invalidate_caches()
 
     # and renormalize it
     # NOTE: Necessary only if (z-1)**2 not in bound above
@@ -70,6 +70,7 @@ class MyGrammarHypothesis(GrammarHypothesis):
         # Set probability for each rule corresponding to value index
         for i in range(1, self.n):
             self.rules[i].p = self.value[i]
+        self.grammar.invalidate_caches()
 
         # Recompute prior for each hypothesis, given new grammar probs
         for cl in self.concept2hypotheses.keys():
@@ -0,0 +1,41 @@
+from LOTlib.Eval import instrumentation
+from SampleStream import SampleStream
+
+class PrimitiveStats(SampleStream):
+    """
+    Turns on primitive instrumentation (LOTlib.Eval.instrumentation) while the stream runs, and on exit shows
+    how many times each primitive was called and how long they took, most time first. Samples pass through,
+    and ops maps each one (compiled while this was on) to the number of primitive calls it made.
+    """
+
+    def __init__(self, reset=True, show=True):
+        self.__dict__.update(locals())
+        SampleStream.__init__(self)
+
+        self.ops = dict()
+
+    def process(self, x):
+        ops = getattr(x, 'primitive_ops', None)
+        if ops is not None:
+            self.ops[x] = ops
+        return x
+
+    def __enter__(self):
+        if self.reset:
+            instrumentation.reset()
+        instrumentation.start()
+
+        SampleStream.__enter__(self)
+
+    def __str__(self):
+        mean = sum(self.ops.values()) / float(max(1, len(self.ops)))
+        return '%s\n# %s primitive calls; %s per hypothesis over %s hypotheses' % \
+            (instrumentation, instrumentation.ops, round(mean, 2), len(self.ops))
+
+    def __exit__(self, t, value, traceback):
+        instrumentation.stop()
+
+        if self.show:
+            print self
+
+        return SampleStream.__exit__(self, t, value, traceback)
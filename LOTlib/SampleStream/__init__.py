@@ -11,6 +11,7 @@ from PosteriorTrace import PosteriorTrace
 from Tee import Tee
 from Save import Save
 from PrintH import PrintH
+from PrimitiveStats import PrimitiveStats
 from Print import Print
 
 # from VectorSummary import VectorSummary ## We cannot import this because it breaks on the cluster -- not matplotlib
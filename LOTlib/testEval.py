@@ -0,0 +1,105 @@
+import unittest
+
+from LOTlib.Eval import FunctionCache
+class FunctionCacheTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing the function cache"
+        cache = FunctionCache(maxsize=2)
+        made = []
+        def make(k):
+            made.append(k)
+            return k.upper()
+        for k in ['a', 'b', 'a', 'c', 'b', 'a']:
+            self.assertEqual(cache.get(k, lambda: make(k)), k.upper())
+        # 'c' evicted 'b' (since 'a' was used more recently), then 'b' evicted 'a'
+        self.assertEqual(made, ['a', 'b', 'c', 'b', 'a'])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 5, 'evictions': 3, 'size': 2})
+
+import __builtin__
+from LOTlib.Eval import primitive, primitives, instrumentation
+from LOTlib.Primitives import load_primitives, get_namespace
+class PrimitiveNamespaceTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing the primitive namespace"
+        @primitive
+        def testing_primitive_(x):
+            return x+1
+        self.assertTrue(primitives['testing_primitive_'] is testing_primitive_)
+        self.assertFalse(hasattr(__builtin__, 'testing_primitive_'))
+
+        load_primitives('Number')
+        self.assertEqual(eval("next_('two_')", primitives), 'three_')
+        self.assertEqual(eval("testing_primitive_(len([1]))", primitives), 2) # python's builtins are still there
+
+        # loading some modules does not keep the others out of the namespace
+        self.assertTrue('plus_' in get_namespace())
+
+from LOTlib.Eval import PrimitiveInstrumentation
+class InstrumentationTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing primitive instrumentation"
+        load_primitives('Arithmetic')
+        plus = primitives['plus_']
+        f = eval("lambda x: plus_(plus_(x, 1), times_(x, 2))", primitives)
+
+        counter = PrimitiveInstrumentation()
+        counter.start()
+        self.assertFalse(primitives['plus_'] is plus)
+        h = lambda: None # anything we can set primitive_ops on
+        g = counter.count(h, f)
+        self.assertEqual((f(1), g(2)), (4, 7))
+        counter.stop()
+        self.assertTrue(primitives['plus_'] is plus)
+
+        self.assertEqual(counter.stats()['plus_'][0], 4)
+        self.assertEqual(counter.stats()['times_'][0], 2)
+        self.assertEqual((counter.ops, h.primitive_ops), (6, 3))
+        f(1)
+        self.assertEqual(counter.ops, 6) # stopped
+
+from LOTlib.Miscellaneous import Infinity
+from LOTlib.Eval import TooBigException
+from LOTlib.Grammar import Grammar
+from LOTlib.Hypotheses.LOTHypothesis import LOTHypothesis
+class BudgetTest(unittest.TestCase):
+    def tearDown(self):
+        instrumentation.counting = False
+        instrumentation.rewrap()
+
+    def runTest(self):
+        print "# Testing evaluation budgets"
+        load_primitives('Arithmetic')
+        plus = primitives['plus_']
+        g = Grammar(start='EXPR')
+        g.add_rule('EXPR', 'plus_', ['EXPR', 'EXPR'], 1.0)
+        g.add_rule('EXPR', 'x', None, 1.5)
+
+        class BudgetedHypothesis(LOTHypothesis):
+            step_budget = 5
+
+        for _ in xrange(100):
+            h = BudgetedHypothesis(g, value=g.generate(), maxnodes=Infinity)
+            plusses = len([n for n in h.value if n.name == 'plus_'])
+            exceeded = instrumentation.exceeded
+            if plusses <= 5:
+                self.assertEqual(h(1), plusses+1)
+            else:
+                self.assertRaises(TooBigException, h, 1)
+                self.assertEqual(instrumentation.exceeded, exceeded+1)
+                self.assertEqual(LOTHypothesis(g, value=h.value, maxnodes=Infinity)(1), plusses+1) # no budget
+
+        # a deadline is checked on every primitive call, even in short programs
+        g = Grammar(start='A') # times_(times_(times_(x, x), x), x)
+        g.add_rule('A', 'times_', ['B', 'X'], 1.0)
+        g.add_rule('B', 'times_', ['C', 'X'], 1.0)
+        g.add_rule('C', 'times_', ['X', 'X'], 1.0)
+        g.add_rule('X', 'x', None, 1.0)
+        class TimedHypothesis(LOTHypothesis):
+            time_budget = 1e-6
+        h = TimedHypothesis(g, maxnodes=Infinity)
+        self.assertRaises(TooBigException, h, 7**200000)
+
+        # and counting stops once no budgeted functions are left
+        del h
+        self.assertFalse(instrumentation.counting)
+        self.assertTrue(primitives['plus_'] is plus)
@@ -0,0 +1,205 @@
+import unittest
+import pickle
+import itertools
+import random
+from copy import copy
+
+from DefaultGrammars import infiniteTestGrammar
+from LOTlib.FunctionNode import FunctionNode, fullstring, pystring
+from LOTlib.Miscellaneous import lambdaOne
+from LOTlib.Hypotheses.Proposers import regeneration_proposal, insert_delete_proposal, copy_regen_proposal, \
+    ProposalFailedException
+from LOTlib.Hypotheses.Proposers.InsertDeleteProposal import can_delete_FunctionNode
+
+class SlotsTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing FunctionNode slots"
+        for _ in xrange(100):
+            t = infiniteTestGrammar.generate()
+            self.assertFalse(hasattr(t, '__dict__'))
+
+            # extra attributes are copied and pickled along with the slots
+            t.set_extra('resample_p', 0.5)
+            self.assertEqual(copy(t).resample_p, 0.5)
+            for protocol in [0, 2]:
+                t2 = pickle.loads(pickle.dumps(t, protocol))
+                self.assertEqual(t2, t)
+                self.assertEqual(t2.resample_p, 0.5)
+                self.assertTrue(t2.check_parent_refs())
+
+            # pickles from when FunctionNodes had a __dict__ are a dict of their attributes
+            fn = FunctionNode.__new__(FunctionNode)
+            fn.__setstate__({'self': fn, 'parent': None, 'returntype': 'A', 'name': 'a', 'args': None, 'added_rule': None, 'resample_p': 0.1})
+            self.assertEqual(fullstring(fn), "a<A>")
+            self.assertEqual(fn.resample_p, 0.1)
+
+class HashTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing FunctionNode hashing and equality"
+        trees = [infiniteTestGrammar.generate() for _ in xrange(200)]
+        subnodes = [n for t in trees for n in t][:500]
+
+        # equality is the same as comparing fullstrings, and equal nodes hash the same
+        for x, y in itertools.product(subnodes, repeat=2):
+            self.assertEqual(x == y, fullstring(x) == fullstring(y))
+            if x == y:
+                self.assertEqual(hash(x), hash(y))
+
+        # changing a node changes the hashes above it
+        for t in trees:
+            t2 = copy(t)
+            self.assertEqual(hash(t2), hash(t))
+            n = t2.sample_subnode()[0]
+            n.setto(infiniteTestGrammar.generate(n.returntype))
+            self.assertEqual(t2 == t, fullstring(t2) == fullstring(t))
+            self.assertEqual(hash(t2), hash(copy(t2)))
+
+class PersistentProposalTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing persistent proposals"
+        for proposal in [regeneration_proposal, insert_delete_proposal, copy_regen_proposal]:
+            t = infiniteTestGrammar.generate()
+            for i in xrange(100):
+                s = fullstring(t)
+                try:
+                    random.seed(i)
+                    copied, fb = proposal(infiniteTestGrammar, t)
+                except ProposalFailedException:
+                    continue
+                random.seed(i)
+                newt, persistent_fb = proposal(infiniteTestGrammar, t, persistent=True)
+
+                # the same proposal, without changing t
+                self.assertEqual(newt, copied)
+                self.assertTrue(fb == persistent_fb or abs(fb - persistent_fb) < 1e-9 or fb != fb)
+                self.assertEqual(fullstring(t), s)
+
+                # and the (possibly shared) parents above each node have the right bound variables
+                path = []
+                for n, d in newt.iterdepth():
+                    del path[d:]
+                    path.append(n)
+                    self.assertEqual([a.added_rule for a in n.up_to() if a.added_rule is not None],
+                                     [a.added_rule for a in reversed(path) if a.added_rule is not None])
+
+                # copying compacts it, so that it has its own nodes with the right parents
+                compacted = copy(newt)
+                self.assertEqual(compacted, newt)
+                self.assertTrue(compacted.check_parent_refs())
+                self.assertEqual(len(set(map(id, compacted)) & set(map(id, newt))), 0)
+                t = newt if i % 10 else compacted
+
+class StringMemoTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing memoized strings"
+        for _ in xrange(200):
+            t = infiniteTestGrammar.generate()
+            s, fs = pystring(t), fullstring(t)
+
+            # rendering a subnode on its own (with different depths and bound variables) doesn't change t's strings
+            n = t.sample_subnode()[0]
+            self.assertEqual(pystring(n), pystring(copy(n)))
+            self.assertEqual(fullstring(n), fullstring(copy(n)))
+            self.assertEqual((pystring(t), fullstring(t)), (s, fs))
+
+            # changing a node changes the strings above it
+            n.setto(infiniteTestGrammar.generate(n.returntype))
+            self.assertEqual((pystring(t), fullstring(t)), (pystring(copy(t)), fullstring(copy(t))))
+
+            # and so does setting a node's name or args
+            hash(t), t.count_nodes()
+            n = t.sample_subnode()[0]
+            if n.args is not None:
+                n.args = list(reversed(n.args))
+            else:
+                n.name = n.name + '_'
+            self.assertEqual((pystring(t), fullstring(t)), (pystring(copy(t)), fullstring(copy(t))))
+            self.assertEqual((hash(t), t.count_nodes()), (hash(copy(t)), copy(t).count_nodes()))
+
+def recursive_walk(t, d=0, postorder=False):
+    if not postorder:
+        yield (t, d)
+    for a in t.argFunctionNodes():
+        for x in recursive_walk(a, d+1, postorder):
+            yield x
+    if postorder:
+        yield (t, d)
+
+class WalkTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing iterative tree walks"
+        for _ in xrange(200):
+            t = infiniteTestGrammar.generate()
+            for postorder in [False, True]:
+                self.assertEqual([(id(n), d) for n, d in t.walk(postorder=postorder, yield_depth=True)],
+                                 [(id(n), d) for n, d in recursive_walk(t, postorder=postorder)])
+            self.assertEqual([id(n) for n in t], [id(n) for n, _ in recursive_walk(t)])
+            self.assertEqual(t.depth(), max([d for _, d in recursive_walk(t)]))
+
+            # iterate_subnodes has the same bound variables in scope as a recursive walk would, and puts them
+            # back even when we stop early
+            nodes = t.subnodes()
+            stop = random.choice(nodes)
+            for n in t.iterate_subnodes(infiniteTestGrammar):
+                self.assertEqual([r for r, _ in infiniteTestGrammar.bv.stack],
+                                 [a.added_rule for a in reversed(list(n.up_to())[1:]) if a.added_rule is not None])
+                if n is stop:
+                    break
+            self.assertEqual(len(infiniteTestGrammar.bv), 0)
+
+        # deeper than the recursion limit
+        t = FunctionNode(None, 'EXPR', 'a', None)
+        for _ in xrange(5000):
+            t = FunctionNode(None, 'EXPR', 'f', [t])
+            t.args[0].parent = t
+        self.assertEqual(t.depth(), 5000)
+        self.assertEqual(len(t), 5001)
+
+class CachedSizeTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing cached sizes and heights"
+        for proposal in [regeneration_proposal, insert_delete_proposal]:
+            for persistent in [False, True]:
+                t = infiniteTestGrammar.generate()
+                for _ in xrange(200):
+                    self.assertEqual((t.count_nodes(), t.depth()), (len(list(t.walk())), max([d for _, d in recursive_walk(t)])))
+                    try:
+                        t, _ = proposal(infiniteTestGrammar, t, persistent=persistent)
+                    except ProposalFailedException:
+                        pass
+
+        # and after changing args directly
+        t = infiniteTestGrammar.generate()
+        for _ in xrange(100):
+            n = t.sample_subnode()[0]
+            if n.args is not None:
+                n.args = [infiniteTestGrammar.generate(a.returntype) if isinstance(a, FunctionNode) else a for a in n.args]
+                for a in n.argFunctionNodes():
+                    a.parent = n
+                n.invalidate_caches()
+            self.assertEqual((t.count_nodes(), t.depth()), (len(list(t.walk())), max([d for _, d in recursive_walk(t)])))
+
+class CachedWeightTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing cached subtree weights"
+        unmarked = lambda x: can_delete_FunctionNode(x) # the same weights, but not cached
+        t = infiniteTestGrammar.generate()
+        for i in xrange(300):
+            for f, g in [(lambdaOne, lambda x: 1.0), (can_delete_FunctionNode, unmarked)]:
+                self.assertAlmostEqual(t.sample_node_normalizer(f), t.sample_node_normalizer(g))
+                if t.sample_node_normalizer(f) > 0:
+                    # going down by subtree weights picks the same node as scanning
+                    random.seed(i)
+                    path, lp = t.sample_subnode_path(f)
+                    random.seed(i)
+                    path2, lp2 = t.sample_subnode_path(g)
+                    self.assertEqual(map(id, path), map(id, path2))
+                    self.assertAlmostEqual(lp, lp2)
+            try:
+                t, _ = insert_delete_proposal(infiniteTestGrammar, t, persistent=(i % 2 == 0))
+            except ProposalFailedException:
+                pass
+            if random.random() < 0.2: # (a persistent tree can't be changed in place, so copy it first)
+                t = copy(t)
+                n = t.sample_subnode()[0]
+                n.setto(infiniteTestGrammar.generate(n.returntype))
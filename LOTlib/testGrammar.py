@@ -2,7 +2,7 @@
 import unittest
 
 from DefaultGrammars import finiteTestGrammar, infiniteTestGrammar
-from LOTlib.FunctionNode import FunctionNode, BVUseFunctionNode, BVAddFunctionNode
+from LOTlib.FunctionNode import FunctionNode, BVUseFunctionNode, BVAddFunctionNode, fullstring
 
 class EnumerationTest(unittest.TestCase):
     def runTest(self):
@@ -53,7 +53,7 @@ class GrammarTreeTest(unittest.TestCase):
 
                         # NOTE: We cannot use "in" here since that uses rule "is", but we've created
                         # a new thing that is equivalent to the rule. So instead, we check the bv name
-                        self.assertTrue(r.name in [r.name for r in grammar.rules[ti.returntype]])
+                        self.assertTrue(r.name in [r.name for r in grammar.get_rules(ti.returntype)])
                         added_rules.append(r)
 
                     if re.match(r'lambda', ti.name):
@@ -88,3 +88,355 @@ class InfinitePackTest(unittest.TestCase):
 
             self.assertTrue(t==t2)
 
+
+class BytePackTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing packing (bytes)"
+        from copy import deepcopy
+        from LOTlib.Grammar import pack_varints, unpack_varints
+        self.assertEqual(unpack_varints(pack_varints([0, 1, 127, 128, 300, 2**40])), [0, 1, 127, 128, 300, 2**40])
+
+        # more rules than pack_ascii can handle
+        grammar = deepcopy(infiniteTestGrammar)
+        for i in xrange(200):
+            grammar.add_rule('A', 'a%s' % i, None, 0.1)
+
+        trees = [grammar.generate() for _ in xrange(1000)]
+        for t in trees:
+            self.assertEqual(grammar.unpack(grammar.pack(t)), t)
+        self.assertEqual(grammar.unpack_many(grammar.pack_many(trees)), trees)
+
+
+
+class SignatureIndexTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing signature index"
+        for grammar in [finiteTestGrammar, infiniteTestGrammar]:
+            for _ in xrange(1000):
+                t = grammar.generate()
+                grammar.log_probability(t)
+
+                for ti in t.iterate_subnodes(grammar):
+                    self.assertTrue(grammar.get_matching_rule(ti).get_rule_signature() == ti.get_rule_signature())
+
+            # all of the bound variable rules should have been removed from the index
+            index = grammar.signature_index
+            grammar.index_rules()
+            self.assertEqual(dict((nt, v) for nt, v in index.items() if v), dict(grammar.signature_index))
+
+
+from math import log, exp
+from LOTlib.BVRuleContextManager import BVRuleContextManager
+
+def uncached_log_probability(grammar, t):
+    """ Compute log_probability summing over the rules at every node, as a check on the cached normalizers """
+    z = log(sum([r.p for r in grammar.get_rules(t.returntype)]))
+    lp = log(grammar.get_matching_rule(t).p) - z
+    with BVRuleContextManager(grammar, t):
+        for a in t.argFunctionNodes():
+            lp += uncached_log_probability(grammar, a)
+    return lp
+
+class NormalizerTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing cached normalizers"
+        for grammar in [finiteTestGrammar, infiniteTestGrammar]:
+            for _ in xrange(1000):
+                t = grammar.generate()
+                self.assertAlmostEqual(grammar.log_probability(t), uncached_log_probability(grammar, t))
+
+            self.assertEqual(len(grammar.bv), 0)
+            for nt, z in grammar.log_normalizers.items():
+                self.assertAlmostEqual(z, log(sum([r.p for r in grammar.get_rules(nt)])))
+
+
+from collections import Counter
+class SampleRuleTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing rule sampling"
+        grammar = finiteTestGrammar
+        N = 20000
+
+        # find a lambda so that B1 has a bound variable rule added
+        t = grammar.generate()
+        while not any(isinstance(n, BVAddFunctionNode) for n in t):
+            t = grammar.generate()
+        lam = [n for n in t if isinstance(n, BVAddFunctionNode)][0]
+
+        for nt in ['A0', 'B1']:
+            with BVRuleContextManager(grammar, lam):
+                rules = grammar.get_rules(nt)
+                z = sum([r.p for r in rules])
+                counts = Counter(id(grammar.sample_rule(nt)) for _ in xrange(N))
+                for r in rules:
+                    self.assertAlmostEqual(float(counts[id(r)])/N, r.p/z, delta=0.02)
+
+
+from LOTlib.Grammar import Grammar, GenerationBudgetException
+class GenerationBudgetTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing generation budgets"
+        grammar = infiniteTestGrammar
+        nfailed = 0
+        for _ in xrange(5000):
+            try:
+                t = grammar.generate(max_depth=4, max_nodes=8)
+                self.assertTrue(t.depth() <= 4)
+                self.assertTrue(t.count_nodes() <= 8)
+                self.assertTrue(t.check_parent_refs())
+            except GenerationBudgetException:
+                nfailed += 1
+
+            self.assertEqual(len(grammar.bv), 0)
+        self.assertTrue(0 < nfailed < 5000)
+
+
+class CountingEnumerationTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing counting, unranking, and sharded enumeration"
+        for grammar, D in [(finiteTestGrammar, 5), (infiniteTestGrammar, 4)]:
+            for leaves in [True, False]:
+                for d in xrange(D):
+                    trees = map(fullstring, grammar.enumerate_at_depth(d, leaves=leaves))
+                    self.assertEqual(grammar.count_at_depth(d, leaves=leaves), len(trees))
+
+                    for k in xrange(len(trees)):
+                        self.assertEqual(fullstring(grammar.unrank_at_depth(k, d, leaves=leaves)), trees[k])
+
+                    shards = []
+                    for w in xrange(3):
+                        shards.extend(map(fullstring, grammar.enumerate_at_depth(d, leaves=leaves, worker=w, nworkers=3)))
+                    self.assertEqual(shards, trees)
+
+
+class CompiledGrammarTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing compiled grammars"
+        from copy import deepcopy
+        grammar = deepcopy(infiniteTestGrammar)
+
+        cg = grammar.compile()
+        self.assertIs(grammar.compile(), cg)
+        for nt in cg.nonterminals:
+            self.assertEqual(cg.nrules(nt), len(grammar.get_rules(nt)))
+            for i, r in enumerate(cg.rules[nt]):
+                self.assertEqual(cg.signature2id[r.get_rule_signature()], i)
+                self.assertEqual(cg.is_terminal[nt][i], grammar.is_terminal_rule(r))
+                self.assertAlmostEqual(exp(cg.log_p[nt][i]), r.p / sum([x.p for x in cg.rules[nt]]))
+
+        # the compiled grammar is remade when the grammar changes, and log probabilities follow it
+        t = grammar.generate()
+        grammar.add_rule('A', 'new', None, 5.0)
+        self.assertIsNot(grammar.compile(), cg)
+        self.assertGreater(grammar.compile().version, cg.version)
+        self.assertAlmostEqual(grammar.log_probability(t), uncached_log_probability(grammar, t))
+
+        # as they do when a rule's p is set directly
+        cg = grammar.compile()
+        r = [x for x in grammar.get_rules(t.returntype) if x.get_rule_signature() == t.get_rule_signature()][0]
+        r.p = r.p * 100.0
+        self.assertIsNot(grammar.compile(), cg)
+        self.assertAlmostEqual(grammar.log_probability(t), uncached_log_probability(grammar, t))
+
+
+class BVContextTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing bound variable contexts"
+        from LOTlib.BVContext import BVContext
+        grammar = infiniteTestGrammar
+
+        t = grammar.generate()
+        while not any(isinstance(n, BVAddFunctionNode) for n in t):
+            t = grammar.generate()
+        lam = [n for n in t if isinstance(n, BVAddFunctionNode)][0]
+        r = lam.added_rule
+        nrules = len(grammar.rules[r.nt])
+
+        # bound variables go on grammar.bv, not in grammar.rules
+        with BVRuleContextManager(grammar, lam):
+            self.assertIs(grammar.get_rules(r.nt)[-1], r)
+            self.assertEqual(len(grammar.rules[r.nt]), nrules)
+        self.assertEqual(len(grammar.bv), 0)
+
+        # or on a separate context
+        context = BVContext()
+        with BVRuleContextManager(grammar, lam, context=context):
+            self.assertEqual(context.rules[r.nt], [r])
+            self.assertEqual(len(grammar.bv), 0)
+        self.assertEqual(len(context), 0)
+        self.assertEqual(context.p, dict())
+
+
+class FrozenGrammarTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing frozen grammars"
+        from copy import deepcopy
+        from threading import Thread
+        from LOTlib.BVContext import BVContext
+        from LOTlib.Hypotheses.Proposers import ProposalFailedException
+        from LOTlib.Hypotheses.Proposers.RegenerationProposal import regeneration_proposal
+        from LOTlib.Hypotheses.Proposers.InsertDeleteProposal import insert_delete_proposal
+        from LOTlib.Hypotheses.Proposers.CopyRegenProposal import copy_regen_proposal
+
+        grammar = deepcopy(infiniteTestGrammar)
+        grammar.freeze()
+        self.assertRaises(AssertionError, grammar.add_rule, 'A', 'new', None, 1.0)
+        self.assertEqual(deepcopy(grammar), infiniteTestGrammar)
+
+        errors = []
+        def work():
+            try:
+                for _ in xrange(500):
+                    t = grammar.generate()
+                    self.assertAlmostEqual(grammar.log_probability(t),
+                                           infiniteTestGrammar.log_probability(t, context=BVContext()))
+                    for proposal in [regeneration_proposal, insert_delete_proposal, copy_regen_proposal]:
+                        try:
+                            proposal(grammar, t)
+                        except ProposalFailedException:
+                            pass
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=work) for _ in xrange(4)]
+        for th in threads: th.start()
+        for th in threads: th.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(grammar.bv), 0)
+
+
+class TreeSizeTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing tree sizes"
+        grammar = finiteTestGrammar
+        trees = list(grammar.enumerate(d=6))
+
+        # the size distribution matches the enumerated trees' probabilities
+        for n in xrange(1, 8):
+            self.assertAlmostEqual(grammar.size_probability(grammar.start, n),
+                                   sum([exp(grammar.log_probability(t)) for t in trees if t.count_nodes() == n]))
+        self.assertAlmostEqual(grammar.termination_probabilities()[grammar.start], 1.0)
+
+        # the fixed points match their closed forms on a grammar without bound variables
+        g = Grammar(start='A')
+        g.add_rule('A', 'f', ['A', 'A'], 0.2)
+        g.add_rule('A', 'a', None, 0.7)
+        self.assertAlmostEqual(g.expected_sizes()['A'], 1.0 / (1.0 - 2 * 0.2 / 0.9))
+        g.add_rule('A', 'g', ['A', 'A'], 0.6) # now supercritical, so sometimes infinite
+        self.assertAlmostEqual(g.termination_probabilities()['A'], 0.7 / 0.8, places=5)
+        self.assertEqual(g.expected_sizes()['A'], float("inf"))
+
+        # conditioned generation is normalized and never too big
+        for maxnodes in [2, 3, 5]:
+            self.assertAlmostEqual(sum([exp(grammar.log_probability_within(t, maxnodes)) for t in trees]), 1.0)
+            for _ in xrange(100):
+                self.assertLessEqual(grammar.generate_within(maxnodes=maxnodes).count_nodes(), maxnodes)
+        self.assertEqual(len(grammar.bv), 0)
+
+        # from a tree that is too big, a move to one that is not cannot be reversed
+        from LOTlib.Hypotheses.Proposers.RegenerationProposal import regeneration_proposal
+        big = [t for t in trees if t.count_nodes() > 3]
+        for t in big[:100]:
+            newt, fb = regeneration_proposal(grammar, t, maxnodes=3)
+            self.assertEqual(fb == float("inf"), newt.count_nodes() <= 3)
+
+import pickle
+from copy import copy
+from LOTlib.FlatTree import FlatTree
+class FlatTreeTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing flat trees"
+        for grammar in [finiteTestGrammar, infiniteTestGrammar]:
+            for _ in xrange(200):
+                t = grammar.generate()
+                ft = grammar.flatten(t)
+                self.assertEqual(len(ft), t.count_nodes())
+                self.assertEqual(grammar.unflatten(ft), t)
+                self.assertEqual(pickle.loads(pickle.dumps(ft)), ft)
+                self.assertAlmostEqual(grammar.flat_log_probability(ft), grammar.log_probability(t))
+
+                # a subtree is encoded the same wherever it is (if its bound variables are bound in it)
+                n = t.sample_subnode()[0]
+                try:
+                    nft = grammar.flatten(copy(n))
+                except AssertionError:
+                    continue
+                k = [i for i, m in enumerate(t) if m is n][0]
+                self.assertEqual(nft.ids.tolist(), ft.ids[k:k+len(nft)].tolist())
+
+import random
+from copy import deepcopy
+from LOTlib.FunctionNode import bv_level_name, pystring
+from LOTlib.Hypotheses.Proposers import insert_delete_proposal, copy_regen_proposal, ProposalFailedException
+def check_levels(test, t):
+    """ Each lambda's bound variable is named by its level, and each bound variable is bound above it """
+    stack = [(t, [])]
+    while stack:
+        n, names = stack.pop()
+        if isinstance(n, BVAddFunctionNode):
+            test.assertEqual(n.added_rule.name, bv_level_name(len(names)))
+            names = names + [n.added_rule.name]
+        elif isinstance(n, BVUseFunctionNode):
+            test.assertTrue(n.name in names)
+        stack.extend([(a, names) for a in n.argFunctionNodes()])
+
+class DeBruijnTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing de Bruijn bound variables"
+        for grammar in [finiteTestGrammar, infiniteTestGrammar]:
+            db = deepcopy(grammar)
+            db.de_bruijn = True
+            for i in xrange(200):
+                # the same trees, strings, and probabilities as with uuids
+                random.seed(i)
+                t = grammar.generate()
+                random.seed(i)
+                u = db.generate()
+                self.assertEqual((pystring(t), fullstring(t)), (pystring(u), fullstring(u)))
+                self.assertAlmostEqual(grammar.log_probability(t), db.log_probability(u))
+                check_levels(self, u)
+
+        # inserting and deleting lambdas renames the ones below
+        db = Grammar(start='EXPR', de_bruijn=True)
+        db.add_rule('EXPR', 'lambda', ['EXPR'], 1.0, bv_type='EXPR', bv_p=0.5)
+        db.add_rule('EXPR', 'f', ['EXPR', 'EXPR'], 0.8)
+        db.add_rule('EXPR', 'a', None, 2.0)
+        for persistent in [False, True]:
+            t = db.generate_size('EXPR', 10)
+            for _ in xrange(500):
+                try:
+                    t, _ = insert_delete_proposal(db, t, persistent=persistent)
+                except ProposalFailedException:
+                    continue
+                check_levels(self, t)
+                db.log_probability(t)
+                if t.count_nodes() > 30:
+                    t = db.generate_size('EXPR', 10)
+
+        # and so does crossover, which moves subtrees to other levels
+        from LOTlib.Hypotheses.LOTHypothesis import LOTHypothesis
+        from LOTlib.Inference.GeneticAlgorithm.GeneticAlgorithm import crossover_lot
+        for _ in xrange(200):
+            x, y = [LOTHypothesis(db, value=db.generate_size('EXPR', 10)) for _ in xrange(2)]
+            for n in crossover_lot(x, y).value:
+                if isinstance(n, BVAddFunctionNode): # (free variables from y may stay unbound, as without de Bruijn)
+                    level = len([a for a in n.up_to() if isinstance(a, BVAddFunctionNode)]) - 1
+                    self.assertEqual(n.added_rule.name, bv_level_name(level))
+
+from LOTlib.FunctionNode import returntype_weight
+class ReturntypeIndexTest(unittest.TestCase):
+    def runTest(self):
+        print "# Testing returntype indexes"
+        t = infiniteTestGrammar.generate()
+        for i in xrange(300):
+            for rt in set([n.returntype for n in t]):
+                paths = list(t.returntype_paths(rt))
+                self.assertEqual([id(p[-1]) for p in paths], [id(n) for n in t if n.returntype == rt])
+                self.assertEqual(t.count_returntype(rt), len(paths))
+                for p in paths:
+                    self.assertTrue(all([a in b.args for a, b in zip(p[1:], p)]))
+                self.assertEqual(t.sample_subnode(returntype_weight(rt))[0].returntype, rt)
+            try:
+                t, _ = copy_regen_proposal(infiniteTestGrammar, t, persistent=(i % 2 == 0))
+            except ProposalFailedException:
+                pass